@@ -1,3 +1,7 @@
 #!/usr/bin/env python
 from .functions import *
 from .pdclust_qc import *
+from .pairwise import *
+from .clustering import *
+from .rendering import *
+from .smoothing import *
@@ -0,0 +1,432 @@
+#!/usr/bin/env python
+
+import os
+import time
+import hashlib
+import pickle
+import numpy as np
+import pandas as pd
+import scipy as sci
+import scipy.sparse
+import scipy.sparse.linalg
+from scipy.cluster import hierarchy
+from scipy.cluster.vq import kmeans2
+from sklearn.manifold import MDS,TSNE
+from sklearn.decomposition import PCA
+from .pairwise import atomic_write,merge_knn,knn_graph,sample_name
+
+
+############################################################
+###In memory results keyed by .matrix_key(), mirrored to cache_dir when given
+results_cache = {}
+
+def matrix_key(values,labels,method,block_size=4096):
+    """
+    Function hashes a matrix (read block_size rows at a time, memmaps included), its labels and a method description
+    Example : matrix_key(pairwise_array.values,pairwise_array.columns.tolist(),"euclidean_transform:ward")
+    Returns sha1 key
+    """
+    key=hashlib.sha1()
+    key.update(repr((list(labels),method,values.shape)).encode())
+    for start in range(0,values.shape[0],block_size):
+        key.update(np.ascontiguousarray(values[start:start+block_size],dtype=np.float64).tobytes())
+    return(key.hexdigest())
+
+def cache_lookup(key,cache_dir=None):
+    """
+    Function returns a cached result from memory or cache_dir/<key>.pkl, None if absent
+    """
+    if key in results_cache:
+        return(results_cache[key])
+    if cache_dir is not None and os.path.isfile(cache_dir+"/"+key+".pkl"):
+        results_cache[key]=pd.read_pickle(cache_dir+"/"+key+".pkl")
+        return(results_cache[key])
+    return(None)
+
+def cache_store(key,result,cache_dir=None):
+    """
+    Function stores a result in memory and, with cache_dir, as cache_dir/<key>.pkl
+    """
+    results_cache[key]=result
+    if cache_dir is not None:
+        os.makedirs(cache_dir,exist_ok=True)
+        atomic_write(cache_dir+"/"+key+".pkl",lambda f : pickle.dump(result,f))
+    return(result)
+
+############################################################
+def correlation_distance(values):
+    """
+    Function returns 1 - pearson correlation between the columns of values (as 1-CNV.iloc[:,2:].corr())
+    """
+    return((1-pd.DataFrame(values).corr()).values)
+
+def cluster_linkage(values,labels,method='ward',transform=None,cache_dir=None,cut_trees=(),**transform_args):
+    """
+    Function hierarchically clusters the rows of values (after transform(values,**transform_args) if given)
+    Linkage, dendrogram and cut_tree assignments are cached by matrix hash and method; reruns with other
+    annotations or cluster counts reuse them. cut_trees precomputes assignments for several cluster counts
+    Example : cluster_linkage(1-CNV.iloc[:,2:].corr(),CNV.iloc[:,2:].columns.tolist(),'ward',cache_dir="/out_dir/results/cluster_cache",cut_trees=range(2,11))
+    Returns clustering dictionary (labels, linkage, dendrogram, cuts)
+    """
+    description=method if transform is None else transform.__name__+":"+repr(sorted(transform_args.items()))+":"+method
+    values=values.values if isinstance(values,pd.DataFrame) else values
+    key=matrix_key(values,labels,description)
+    clustering=cache_lookup(key,cache_dir)
+    computed=clustering is None
+    if computed:
+        print("Running : Hierarchical clustering")
+        t0 = time.time()
+        observations=values if transform is None else transform(values,**transform_args)
+        Z = hierarchy.linkage(observations, method)
+        dn = hierarchy.dendrogram(Z, labels = pd.Index(labels),no_plot=True)
+        clustering={'key':key,
+                    'method':description,
+                    'labels':list(labels),
+                    'linkage':Z,
+                    'dendrogram':{x:dn[x] for x in ['icoord','dcoord','ivl','leaves']},
+                    'cuts':{}}
+        print(time.time()-t0)
+    missing=[x for x in cut_trees if x not in clustering['cuts']]
+    if len(missing)>0:
+        cutree=hierarchy.cut_tree(clustering['linkage'], n_clusters=missing)
+        for num,x in enumerate(missing):
+            clustering['cuts'][x]=cutree[:,num]
+    if computed or len(missing)>0:
+        cache_store(key,clustering,cache_dir)
+    return(clustering)
+
+def cluster_assignments(clustering,cut_tree,column,cache_dir=None):
+    """
+    Function cuts a .cluster_linkage() tree into cut_tree clusters, reusing cached cuts
+    Example : cluster_assignments(.cluster_linkage() output,3,'pdclust_clusters')
+    Returns Dataframe of cluster letters indexed by labels
+    """
+    if cut_tree not in clustering['cuts']:
+        clustering['cuts'][cut_tree]=hierarchy.cut_tree(clustering['linkage'], n_clusters=cut_tree)[:,0]
+        cache_store(clustering['key'],clustering,cache_dir)
+    clusters=pd.DataFrame(index=clustering['labels'])
+    clusters[column]=[chr(x+65) for x in clustering['cuts'][cut_tree]]
+    return(clusters)
+############################################################
+def cnv_knn_graph(CNV,k=15,block_size=1024):
+    """
+    Function builds a k nearest neighbour graph of cells from a .pullStatistics() CNV array
+    Distances are 1 - pearson correlation between cells (as plot_dendrogram_CNV), computed block_size cells at a time
+    Example : cnv_knn_graph(CNV_array,15)
+    Returns dictionary of samples, labels, distances and shared window count CSR matrices (see .pool_pairwise_knn())
+    """
+    print("Running : CNV nearest neighbour graph")
+    t0 = time.time()
+    cells=CNV.iloc[:,2:].columns.tolist()
+    values=CNV.iloc[:,2:].values.astype(np.float64)
+    ###Standardise cells so correlations are dot products, missing windows contribute nothing
+    observed=np.isfinite(values)
+    values=np.where(observed,values,np.nanmean(values,axis=0))
+    values=values-values.mean(axis=0)
+    norms=np.sqrt((values**2).sum(axis=0))
+    values=values/np.where(norms>0,norms,np.nan)
+    observed=observed.astype(np.float64)
+    cell_count=len(cells)
+    k=min(k,max(cell_count-1,1))
+    knn={'distance':np.full((cell_count,k),np.inf),
+         'index':np.full((cell_count,k),-1,dtype=np.int64),
+         'shared':np.zeros((cell_count,k))}
+    for row_start in range(0,cell_count,block_size):
+        rows=np.arange(row_start,min(row_start+block_size,cell_count))
+        for col_start in range(0,cell_count,block_size):
+            cols=np.arange(col_start,min(col_start+block_size,cell_count))
+            merge_knn(knn,rows,cols,1-values[:,rows].T.dot(values[:,cols]),observed[:,rows].T.dot(observed[:,cols]))
+    graph=knn_graph(knn,cells)
+    graph['labels']=cells
+    print(time.time()-t0)
+    return(graph)
+
+def snn_graph(graph,prune=1/15):
+    """
+    Function converts a nearest neighbour graph (.pool_pairwise_knn(), .cnv_knn_graph()) into a shared nearest neighbour graph
+    Edges are weighted by the jaccard index of the cells' neighbourhoods (each including the cell), weights below prune are dropped
+    Returns symmetric N x N CSR matrix of weights
+    """
+    distances=graph['distances'].tocsr()
+    cell_count=distances.shape[0]
+    neighbours=sci.sparse.csr_matrix((np.ones(len(distances.indices)),distances.indices,distances.indptr),shape=distances.shape)
+    neighbours=(neighbours+sci.sparse.identity(cell_count,format='csr'))
+    neighbours.data[:]=1
+    shared=neighbours.dot(neighbours.T).tocoo()
+    size=np.asarray(neighbours.sum(axis=1)).ravel()
+    jaccard=shared.data/(size[shared.row]+size[shared.col]-shared.data)
+    keep=(jaccard>=prune)&(shared.row!=shared.col)
+    return(sci.sparse.csr_matrix((jaccard[keep],(shared.row[keep],shared.col[keep])),shape=(cell_count,cell_count)))
+
+def spectral_clusters(weights,n_clusters,seed=0,restarts=10):
+    """
+    Function partitions a weighted graph into n_clusters by k-means on the leading eigenvectors of its normalised adjacency
+    Clusters are numbered by first appearance, as hierarchy.cut_tree numbers them
+    Returns array of cluster numbers
+    """
+    cell_count=weights.shape[0]
+    degree=np.asarray(weights.sum(axis=1)).ravel()
+    scale=sci.sparse.diags(1/np.sqrt(np.where(degree>0,degree,1)))
+    normalised=scale.dot(weights).dot(scale)
+    if cell_count<=max(4*n_clusters,200):
+        eigenvalues,eigenvectors=np.linalg.eigh(normalised.toarray())
+        eigenvectors=eigenvectors[:,::-1][:,:n_clusters]
+    else:
+        eigenvalues,eigenvectors=sci.sparse.linalg.eigsh(normalised,k=n_clusters,which='LA',
+                                                          v0=np.random.RandomState(seed).rand(cell_count))
+    norms=np.sqrt((eigenvectors**2).sum(axis=1))
+    embedding=eigenvectors/np.where(norms>0,norms,1)[:,None]
+    random_state=np.random.RandomState(seed)
+    best=None
+    for x in range(0,restarts):
+        centroids,clusters=kmeans2(embedding,n_clusters,minit='++',seed=random_state)
+        inertia=((embedding-centroids[clusters])**2).sum()
+        if best is None or inertia<best[0]:
+            best=(inertia,clusters)
+    clusters=best[1]
+    ###Renumber by first appearance
+    first=np.unique(clusters,return_index=True)[1]
+    order=np.unique(clusters)[np.argsort(first)]
+    renumber=np.zeros(clusters.max()+1,dtype=np.int64)
+    renumber[order]=np.arange(0,len(order))
+    return(renumber[clusters])
+
+def graph_clusters(graph,n_clusters,column,prune=1/15,seed=0):
+    """
+    Graph based alternative to the ward clustering of plotPairwise_heatmap and plot_dendrogram_CNV that never forms N x N arrays
+    Shared nearest neighbour graph of a nearest neighbour graph (.pool_pairwise_knn(), .cnv_knn_graph()) split by spectral clustering
+    Example : graph_clusters(.pool_pairwise_knn() output,3,'pdclust_clusters') ; graph_clusters(.cnv_knn_graph() output,3,'cnv_clusters')
+    Returns Dataframe of cluster letters indexed by labels
+    """
+    print("Running : Graph clustering")
+    t0 = time.time()
+    clusters=pd.DataFrame(index=graph['labels'])
+    clusters[column]=[chr(x+65) for x in spectral_clusters(snn_graph(graph,prune),n_clusters,seed)]
+    print(time.time()-t0)
+    return(clusters)
+############################################################
+def squared_distance_blocks(values,rows=None,block_size=1024):
+    """
+    Function yields (row indices, squared distances) blocks of block_size rows of values (memmaps included), NaN as 0
+    """
+    rows=np.arange(0,values.shape[0]) if rows is None else np.asarray(rows)
+    for start in range(0,len(rows),block_size):
+        block=rows[start:start+block_size]
+        yield(block,np.nan_to_num(np.asarray(values[block],dtype=np.float64))**2)
+
+def classical_mds(values,n_components=2,seed=0,block_size=1024):
+    """
+    Function embeds a symmetric distance matrix by classical (Torgerson) MDS
+    The leading eigenvectors of the double centred squared distances are found by a truncated eigendecomposition
+    whose products read values block_size rows at a time, so no further N x N arrays are formed
+    Returns N x n_components coordinates
+    """
+    cell_count=values.shape[0]
+    row_means=np.zeros(cell_count)
+    for rows,squared in squared_distance_blocks(values,None,block_size):
+        row_means[rows]=squared.mean(axis=1)
+    grand_mean=row_means.mean()
+    def centred_product(vector):
+        vector=np.asarray(vector,dtype=np.float64).ravel()
+        product=np.zeros(cell_count)
+        for rows,squared in squared_distance_blocks(values,None,block_size):
+            product[rows]=squared.dot(vector)
+        return(-0.5*(product-row_means*vector.sum()-row_means.dot(vector)+grand_mean*vector.sum()))
+    if cell_count<=max(4*n_components,200):
+        centred=np.column_stack([centred_product(x) for x in np.identity(cell_count)])
+        eigenvalues,eigenvectors=np.linalg.eigh(centred)
+        eigenvalues,eigenvectors=eigenvalues[::-1][:n_components],eigenvectors[:,::-1][:,:n_components]
+    else:
+        operator=sci.sparse.linalg.LinearOperator((cell_count,cell_count),matvec=centred_product,dtype=np.float64)
+        eigenvalues,eigenvectors=sci.sparse.linalg.eigsh(operator,k=n_components,which='LA',
+                                                          v0=np.random.RandomState(seed).rand(cell_count))
+        order=np.argsort(eigenvalues)[::-1]
+        eigenvalues,eigenvectors=eigenvalues[order],eigenvectors[:,order]
+    return(eigenvectors*np.sqrt(np.maximum(eigenvalues,0)))
+
+def landmark_mds(values,n_components=2,landmarks=500,seed=0,block_size=1024):
+    """
+    Function embeds a symmetric distance matrix by landmark MDS
+    Classical MDS of landmarks randomly chosen cells, the remaining cells are placed by distance based triangulation
+    from their distances to the landmarks, only landmark rows of values are read
+    Returns N x n_components coordinates
+    """
+    cell_count=values.shape[0]
+    chosen=np.sort(np.random.RandomState(seed).choice(cell_count,min(landmarks,cell_count),replace=False))
+    to_landmarks=np.zeros((len(chosen),cell_count))
+    for num,(rows,squared) in enumerate(squared_distance_blocks(values,chosen,block_size)):
+        to_landmarks[num*block_size:num*block_size+len(rows)]=squared
+    landmark_squared=to_landmarks[:,chosen]
+    landmark_count=len(chosen)
+    centring=np.identity(landmark_count)-1/landmark_count
+    eigenvalues,eigenvectors=np.linalg.eigh(-0.5*centring.dot(landmark_squared).dot(centring))
+    eigenvalues,eigenvectors=eigenvalues[::-1][:n_components],eigenvectors[:,::-1][:,:n_components]
+    eigenvalues=np.where(eigenvalues>0,eigenvalues,np.inf)
+    return(-0.5*(to_landmarks-landmark_squared.mean(axis=1)[:,None]).T.dot(eigenvectors/np.sqrt(eigenvalues)))
+
+def cell_embedding(values,labels,method='smacof',n_components=2,cache_dir=None,seed=1,landmarks=500,block_size=1024):
+    """
+    Function embeds cells from their pairwise distances, cached by matrix hash and method (see .cluster_linkage())
+    so plots can be redrawn with other annotations without refitting
+    Methods : 'smacof' (sklearn MDS), 'classical' (truncated eigendecomposition MDS), 'landmark' (landmark MDS on landmarks cells),
+    'pca' (PCA of the distance rows), 'randomized_pca' (randomized PCA of the distance rows)
+    Example : cell_embedding(pairwise_array.values,pairwise_array.columns.tolist(),'landmark',cache_dir="/out_dir/results/cluster_cache")
+    Returns embedding dictionary (labels, coordinates, explained_variance_ratio for PCA methods)
+    """
+    values=values.values if isinstance(values,pd.DataFrame) else values
+    description="embedding:"+method+":"+repr((n_components,seed)+((landmarks,) if method=='landmark' else ()))
+    key=matrix_key(values,labels,description)
+    embedding=cache_lookup(key,cache_dir)
+    if embedding is not None:
+        return(embedding)
+    print("Running : "+method+" embedding")
+    t0 = time.time()
+    explained=None
+    if method=='classical':
+        coordinates=classical_mds(values,n_components,seed,block_size)
+    elif method=='landmark':
+        coordinates=landmark_mds(values,n_components,landmarks,seed,block_size)
+    elif method in ['pca','randomized_pca']:
+        pca=PCA(n_components=n_components,svd_solver='randomized' if method=='randomized_pca' else 'auto',random_state=seed)
+        coordinates=pca.fit_transform(np.asarray(values))
+        explained=pca.explained_variance_ratio_
+    else:
+        coordinates=MDS(n_components=n_components,dissimilarity='precomputed',random_state=seed).fit_transform(np.asarray(values))
+    embedding={'key':key,
+               'method':description,
+               'labels':list(labels),
+               'coordinates':coordinates,
+               'explained_variance_ratio':explained}
+    print(time.time()-t0)
+    return(cache_store(key,embedding,cache_dir))
+############################################################
+def force_layout(distances,n_epochs=300,negative_samples=5,seed=0):
+    """
+    Function lays out a nearest neighbour graph in 2D in NumPy : each epoch pulls neighbours together
+    and pushes negative_samples random cells per edge apart (UMAP style forces), with a decaying step
+    Returns N x 2 coordinates
+    """
+    graph=distances.tocoo()
+    cell_count=graph.shape[0]
+    random_state=np.random.RandomState(seed)
+    coordinates=random_state.uniform(-10,10,(cell_count,2))
+    ###Closer neighbours pull harder
+    scale=np.maximum(np.median(graph.data),1e-12) if len(graph.data)>0 else 1
+    weights=np.exp(-graph.data/scale)
+    heads=np.concatenate([graph.row,graph.col])
+    tails=np.concatenate([graph.col,graph.row])
+    weights=np.concatenate([weights,weights])
+    counts=np.maximum(np.bincount(heads,minlength=cell_count)*(1+negative_samples),1)[:,None]
+    for epoch in range(0,n_epochs):
+        step=1-epoch/n_epochs
+        moves=np.zeros((cell_count,2))
+        difference=coordinates[heads]-coordinates[tails]
+        squared=(difference**2).sum(axis=1)
+        pull=np.clip(-2*weights[:,None]*difference/(1+squared)[:,None],-4,4)
+        negatives=random_state.randint(0,cell_count,len(heads)*negative_samples)
+        repeated=np.repeat(heads,negative_samples)
+        difference=coordinates[repeated]-coordinates[negatives]
+        squared=(difference**2).sum(axis=1)
+        push=np.clip(2*difference/((0.001+squared)*(1+squared))[:,None],-4,4)
+        for dimension in range(0,2):
+            moves[:,dimension]=np.bincount(heads,weights=pull[:,dimension],minlength=cell_count)+\
+                np.bincount(repeated,weights=push[:,dimension],minlength=cell_count)
+        coordinates+=step*moves*(1+negative_samples)/counts
+    return(coordinates)
+
+def graph_embedding(graph,method='tsne',perplexity=30,n_epochs=300,seed=1,cache_dir=None):
+    """
+    Function embeds cells in 2D from a nearest neighbour graph (.pool_pairwise_knn(), .cnv_knn_graph()) without N x N arrays
+    Methods : 'tsne' (sklearn Barnes-Hut t-SNE on the precomputed sparse distances), 'force' (.force_layout())
+    t-SNE needs every cell to keep k>=3*perplexity+2 neighbours (k=92 for perplexity 30); otherwise perplexity is lowered
+    with a warning, and with fewer than 5 neighbours on some cell (small k, or neighbours lost to undefined distances)
+    the force layout is used instead
+    Cached by graph and method as .cell_embedding()
+    Example : graph_embedding(.pool_pairwise_knn() output,'tsne')
+    Returns embedding dictionary (labels, coordinates)
+    """
+    distances=graph['distances'].tocsr()
+    if method=='tsne':
+        ###sklearn asks every row for int(3*perplexity+1) neighbours besides the cell itself
+        neighbours=np.diff(distances.indptr).min()
+        if neighbours<5:
+            print("WARNING: some cells keep only "+str(neighbours)+" neighbours, t-SNE needs at least 5. Using the force layout")
+            method='force'
+        elif int(3*perplexity+1)+1>neighbours:
+            print("WARNING: perplexity "+str(perplexity)+" needs k>="+str(int(3*perplexity+1)+1)+" neighbours per cell, "+
+                  "lowered to "+str(round((neighbours-2)/3,2)))
+            perplexity=(neighbours-2)/3
+    description="graph_embedding:"+method+":"+repr((perplexity,seed) if method=='tsne' else (n_epochs,seed))
+    key=matrix_key(np.concatenate([distances.data,distances.indices,distances.indptr]).astype(np.float64)[:,None],
+                   graph['labels'],description)
+    embedding=cache_lookup(key,cache_dir)
+    if embedding is not None:
+        return(embedding)
+    print("Running : "+method+" graph embedding")
+    t0 = time.time()
+    if method=='tsne':
+        coordinates=TSNE(n_components=2,perplexity=perplexity,metric='precomputed',
+                         init='random',method='barnes_hut',random_state=seed).fit_transform(distances)
+    else:
+        coordinates=force_layout(distances,n_epochs,seed=seed)
+    embedding={'key':key,
+               'method':description,
+               'labels':list(graph['labels']),
+               'coordinates':coordinates,
+               'explained_variance_ratio':None}
+    print(time.time()-t0)
+    return(cache_store(key,embedding,cache_dir))
+############################################################
+def methylation_pca(matrix,n_components=2,chr_list=None,min_cells=2,oversamples=10,n_iter=4,seed=0):
+    """
+    Function embeds cells by randomized truncated SVD of their methylation, without any pairwise step
+    matrix is a sparse cell x CpG matrix (.load_cpg_matrix()) or cell x region features (.window_methylation_features())
+    Each CpG/region is centred on the mean of the cells covering it and missing calls count as that mean,
+    the centred matrix is only applied through sparse products. CpGs/regions covered in fewer than min_cells cells are dropped
+    chr_list decodes CpG keys into chr/start for the loadings
+    Example : methylation_pca(.load_cpg_matrix() output,2,chr_list)
+    Returns embedding dictionary (labels, coordinates, explained_variance_ratio, loadings Dataframe of features x components)
+    """
+    print("Running : Methylation PCA")
+    t0 = time.time()
+    if 'fraction' in matrix:
+        coverage=sci.sparse.csr_matrix(np.isfinite(matrix['fraction']).astype(np.float64))
+        methylation=sci.sparse.csr_matrix(np.nan_to_num(matrix['fraction']).astype(np.float64))
+        features=matrix['regions'].reset_index(drop=True)
+    else:
+        coverage=matrix['coverage'].astype(np.float64).tocsr()
+        methylation=matrix['methylation'].astype(np.float64).tocsr()
+        keys=np.asarray(matrix['cpg_index'],dtype=np.int64)
+        features=pd.DataFrame({'cpg_key':keys}) if chr_list is None else \
+            pd.DataFrame({'chr':np.asarray(chr_list,dtype=object)[keys>>32],'start':keys&0xFFFFFFFF})
+    cells=np.asarray(coverage.sum(axis=0)).ravel()
+    keep=np.flatnonzero(cells>=min_cells)
+    coverage=coverage[:,keep]
+    methylation=methylation[:,keep]
+    features=features.iloc[keep].reset_index(drop=True)
+    cells=cells[keep]
+    means=np.asarray(methylation.sum(axis=0)).ravel()/cells
+    ###Products with the centred matrix (methylation - coverage * means)
+    def product(block):
+        return(methylation.dot(block)-coverage.dot(means[:,None]*block))
+    def transpose_product(block):
+        return(methylation.T.dot(block)-means[:,None]*coverage.T.dot(block))
+    rank=min(n_components+oversamples,coverage.shape[0],coverage.shape[1])
+    basis=np.linalg.qr(product(np.random.RandomState(seed).normal(size=(coverage.shape[1],rank))))[0]
+    for x in range(0,n_iter):
+        basis=np.linalg.qr(transpose_product(basis))[0]
+        basis=np.linalg.qr(product(basis))[0]
+    projected=transpose_product(basis).T
+    left,singular,right=np.linalg.svd(projected,full_matrices=False)
+    coordinates=basis.dot(left[:,:n_components])*singular[:n_components]
+    total=methylation.multiply(methylation).sum()-(cells*means**2).sum()
+    components=["PC"+str(x+1) for x in range(0,n_components)]
+    loadings=pd.concat([features,pd.DataFrame(right[:n_components].T,columns=components)],axis=1)
+    embedding={'method':'methylation_pca:'+repr((n_components,min_cells,seed)),
+               'labels':matrix['labels'] if 'labels' in matrix else [sample_name(x) for x in matrix['samples']],
+               'coordinates':coordinates,
+               'explained_variance_ratio':singular[:n_components]**2/total,
+               'loadings':loadings}
+    print(time.time()-t0)
+    return(embedding)
+############################################################
@@ -0,0 +1,1375 @@
+#!/usr/bin/env python
+
+import os
+import multiprocessing as mp
+import time
+import functools
+import shutil
+import tempfile
+import hashlib
+import json
+import glob
+import socket
+import numpy as np
+import scipy as sci
+import scipy.sparse
+from scipy.spatial import distance
+import pandas as pd
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    ### python<3.8 falls back to memory mapped .npy files
+    shared_memory = None
+
+
+############################################################
+def cpg_keys(chromosomes,starts,chr_list):
+    """
+    Function encodes CpG coordinates as sortable integer keys (chromosome index * 2**32 + start)
+    Example : cpg_keys(["chr1","chr2"],[10468,10470],["chr1","chr2"])
+    Returns int64 keys and boolean mask of coordinates on chr_list
+    """
+    chr_codes=pd.Categorical(chromosomes,categories=chr_list).codes.astype(np.int64)
+    keep=chr_codes>=0
+    keys=(chr_codes<<32)|np.asarray(starts,dtype=np.int64)
+    return(keys,keep)
+
+############################################################
+def read_fractional_methylation(cpg_file,chr_list):
+    """
+    Function reads a .fractional_methylation.bed.gz once into integer CpG keys
+    Keeps binary calls only (meth==0 | meth==1) as pairwise_combination does
+    Example : read_fractional_methylation("/out_dir/extract/A/A.fractional_methylation.bed.gz",["chr1","chr2"])
+    Returns sorted unique int64 CpG keys and float32 methylation calls
+    """
+    cpg=pd.read_csv(cpg_file,
+                    compression='gzip',
+                    sep="\t",
+                    header=None,
+                    names=['chr','start','stop','A','B','C','meth'],
+                    usecols=['chr','start','meth'],
+                    dtype={'chr':object,'start':np.int64,'meth':float})
+    meth=cpg['meth'].fillna(0.0).values
+    keys,keep=cpg_keys(cpg['chr'].values,cpg['start'].values,chr_list)
+    keep&=(meth==0)|(meth==1)
+    keys,first=np.unique(keys[keep],return_index=True)
+    return(keys,meth[keep][first].astype(np.float32))
+
+############################################################
+def read_cpg_counts(cpg_file,chr_list):
+    """
+    Function reads a .fractional_methylation.bed.gz once into integer CpG keys with methylated and total read counts
+    Example : read_cpg_counts("/out_dir/extract/A/A.fractional_methylation.bed.gz",["chr1","chr2"])
+    Returns sorted unique int64 CpG keys, int32 methylated counts and int32 coverage
+    """
+    cpg=pd.read_csv(cpg_file,
+                    compression='gzip',
+                    sep="\t",
+                    header=None,
+                    names=['chr','start','end','meth_cov','unmeth_cov','cov','meth_frac'],
+                    usecols=['chr','start','meth_cov','cov'],
+                    dtype={'chr':object,'start':np.int64,'meth_cov':float,'cov':float})
+    keys,keep=cpg_keys(cpg['chr'].values,cpg['start'].values,chr_list)
+    keys,first=np.unique(keys[keep],return_index=True)
+    counts=cpg[['meth_cov','cov']].values[keep][first]
+    ###Read counts are parsed as float as before, then checked before the int32 conversion
+    if not (np.isfinite(counts).all() and (counts>=0).all() and (counts==np.round(counts)).all()):
+        raise ValueError(cpg_file+" holds missing, negative or non integer meth_cov/cov read counts")
+    return(keys,counts[:,0].astype(np.int32),counts[:,1].astype(np.int32))
+
+def group_cpg_counts(groups,chr_list,core_count=4,cpg_index=None,batch_size=32):
+    """
+    Function sums methylated and total read counts per CpG over the cells of each group (pseudo-bulk)
+    Every file is parsed once, core_count at a time. With cpg_index (.load_reference_cpgs(), e.g. /ref/<ref>.CG.bed.gz)
+    counts are added into preallocated groups x CpGs arrays as they arrive; without it each group's counts are reduced
+    over its own CpGs every batch_size files and placed on the union of the groups' CpGs at the end
+    Example : group_cpg_counts([[A1,A2,A3],[B1,B2,B3]],["chr1","chr2"],4,.load_reference_cpgs() output)
+    Returns dictionary of groups, CpG keys and int32 groups x CpGs methylated and coverage arrays
+    """
+    print("Running : Accumulating group CpG counts")
+    t0 = time.time()
+    members=[(num,cpg_file) for num,group in enumerate(groups) for cpg_file in group]
+    pool = mp.Pool(core_count)
+    parsed=zip(members,pool.imap(functools.partial(read_cpg_counts,chr_list=chr_list),[x[1] for x in members]))
+    counts={}
+    counts['groups']=[chr(x+65) for x in range(0,len(groups))]
+    if cpg_index is None:
+        reduced=[(np.zeros(0,dtype=np.int64),np.zeros(0,dtype=np.int64),np.zeros(0,dtype=np.int64)) for x in groups]
+        batches=[[] for x in groups]
+
+        def reduce_group(num):
+            keys,methylated,coverage=[np.concatenate(x) for x in zip(reduced[num],*batches[num])]
+            keys,inverse=np.unique(keys,return_inverse=True)
+            reduced[num]=(keys,
+                          np.bincount(inverse,weights=methylated,minlength=len(keys)).astype(np.int64),
+                          np.bincount(inverse,weights=coverage,minlength=len(keys)).astype(np.int64))
+            batches[num]=[]
+
+        for (num,cpg_file),cell_counts in parsed:
+            batches[num].append(cell_counts)
+            if len(batches[num])>=batch_size:
+                reduce_group(num)
+        for num in range(0,len(groups)):
+            reduce_group(num)
+        cpg_index=np.unique(np.concatenate([x[0] for x in reduced]))
+        counts['cpg_index']=cpg_index
+        counts['methylated']=np.zeros((len(groups),len(cpg_index)),dtype=np.int32)
+        counts['coverage']=np.zeros((len(groups),len(cpg_index)),dtype=np.int32)
+        for num,(keys,methylated,coverage) in enumerate(reduced):
+            idx=np.searchsorted(cpg_index,keys)
+            counts['methylated'][num,idx]=methylated
+            counts['coverage'][num,idx]=coverage
+        del reduced
+    else:
+        counts['cpg_index']=cpg_index
+        counts['methylated']=np.zeros((len(groups),len(cpg_index)),dtype=np.int32)
+        counts['coverage']=np.zeros((len(groups),len(cpg_index)),dtype=np.int32)
+        for (num,cpg_file),(keys,methylated,coverage) in parsed:
+            idx,found=cpg_positions(cpg_index,keys)
+            counts['methylated'][num,idx[found]]+=methylated[found]
+            counts['coverage'][num,idx[found]]+=coverage[found]
+    pool.close()
+    del pool
+    print(time.time()-t0)
+    return(counts)
+
+############################################################
+def load_reference_cpgs(reference_cpgs,chr_list):
+    """
+    Function reads the genome wide reference CpGs (.checkReferenceFiles() .CG.bed.gz) into integer CpG keys
+    Example : load_reference_cpgs("/ref/hg38_no_alt.CG.bed.gz",["chr1","chr2"])
+    Returns sorted int64 CpG keys
+    """
+    print("Running : Loading reference CpGs")
+    t0 = time.time()
+    reference=pd.read_csv(reference_cpgs,
+                          names=['chr','start','stop'],
+                          usecols=['chr','start'],
+                          dtype={'chr':object,'start':np.int64},
+                          sep='\t',
+                          compression='gzip')
+    keys,keep=cpg_keys(reference['chr'].values,reference['start'].values,chr_list)
+    del reference
+    cpg_index=np.unique(keys[keep])
+    print(time.time()-t0)
+    return(cpg_index)
+
+############################################################
+def cpg_positions(cpg_index,keys):
+    """
+    Function locates CpG keys within a sorted CpG index
+    Returns positions and boolean mask of keys present in the index
+    """
+    idx=np.clip(np.searchsorted(cpg_index,keys),0,len(cpg_index)-1)
+    return(idx,cpg_index[idx]==keys)
+
+############################################################
+def load_cpg_matrix(cpgs,chr_list,core_count=4,cpg_index=None):
+    """
+    Function parses each single cell CpG file exactly once into a shared integer indexed sparse cell x CpG matrix
+    Example : load_cpg_matrix(["SampleA","SampleB"],["chr1","chr2"],4)
+    Returns dictionary of samples, CpG keys, coverage and methylation CSR matrices (shared structure)
+    """
+    print("Running : Loading CpG matrix")
+    t0 = time.time()
+    pool = mp.Pool(core_count)
+    parsed=pool.starmap(read_fractional_methylation,[(x,chr_list) for x in cpgs])
+    pool.close()
+    del pool
+    if cpg_index is None:
+        cpg_index=np.unique(np.concatenate([keys for keys,meth in parsed]))
+
+    indptr=np.zeros(len(parsed)+1,dtype=np.int64)
+    indices=[]
+    data=[]
+    for num,(keys,meth) in enumerate(parsed):
+        idx,found=cpg_positions(cpg_index,keys)
+        indices.append(idx[found].astype(np.int32))
+        data.append(meth[found])
+        indptr[num+1]=indptr[num]+found.sum()
+    del parsed
+    indices=np.concatenate(indices)
+    data=np.concatenate(data)
+
+    cpg_matrix={}
+    cpg_matrix['samples']=list(cpgs)
+    cpg_matrix['cpg_index']=cpg_index
+    cpg_matrix['coverage']=sci.sparse.csr_matrix(
+        (np.ones(len(indices),dtype=np.float32),indices,indptr),shape=(len(cpgs),len(cpg_index)))
+    cpg_matrix['methylation']=sci.sparse.csr_matrix(
+        (data,indices,indptr),shape=(len(cpgs),len(cpg_index)))
+    print(time.time()-t0)
+    return(cpg_matrix)
+
+############################################################
+def distances_from_counts(shared,meth_x,meth_y,meth_xy,difference_type):
+    """
+    Function converts shared CpG counts of binary calls into pairwise distances
+    Counts are sums over shared CpGs : shared=n, meth_x=sum(x), meth_y=sum(y), meth_xy=sum(x*y)
+    Possible distance functions: 'pearson','euclid_dist','man_dist','man_dist_scaled','euclid_dist_scaled'
+    Default : 'man_dist_scaled'
+    Returns array of distances
+    """
+    shared=np.asarray(shared,dtype=np.float64)
+    meth_x=np.asarray(meth_x,dtype=np.float64)
+    meth_y=np.asarray(meth_y,dtype=np.float64)
+    meth_xy=np.asarray(meth_xy,dtype=np.float64)
+    ###Calls are 0/1 so |x-y| and (x-y)**2 both count discordant CpGs
+    discordant=meth_x+meth_y-2*meth_xy
+    with np.errstate(divide='ignore',invalid='ignore'):
+        if difference_type=='pearson':
+            covariance=shared*meth_xy-meth_x*meth_y
+            variance=(shared*meth_x-meth_x**2)*(shared*meth_y-meth_y**2)
+            difference=1-covariance/np.sqrt(variance)
+        elif difference_type=='euclid_dist':
+            difference=np.sqrt(discordant)
+        elif difference_type=='man_dist':
+            difference=discordant
+        elif difference_type=='euclid_dist_scaled':
+            difference=np.sqrt(discordant/shared)
+        else :
+            difference=discordant/shared
+    return(difference)
+
+############################################################
+def pairwise_counts_sparse(cpg_matrix,rows,cols):
+    """
+    Function computes shared CpG counts between two sets of cells of a .load_cpg_matrix() output
+    Example : pairwise_counts_sparse(.load_cpg_matrix() output,[0,1],[0,1,2])
+    Returns shared, meth_x, meth_y and meth_xy arrays of shape rows x cols
+    """
+    coverage=cpg_matrix['coverage']
+    methylation=cpg_matrix['methylation']
+    cov_x=coverage[rows].astype(np.float64)
+    meth_x=methylation[rows].astype(np.float64)
+    cov_y=coverage[cols].astype(np.float64).T.tocsc()
+    meth_y=methylation[cols].astype(np.float64).T.tocsc()
+    meth_x.eliminate_zeros()
+    meth_y.eliminate_zeros()
+    return(
+        (cov_x@cov_y).toarray(),
+        (meth_x@cov_y).toarray(),
+        (cov_x@meth_y).toarray(),
+        (meth_x@meth_y).toarray()
+    )
+
+############################################################
+def pairwise_distances_sparse(cpg_matrix,difference_type,block_size=256,output=None):
+    """
+    Function computes all pairwise distances from a .load_cpg_matrix() output in row blocks
+    With output (.create_distance_memmap() output) row blocks are written straight to disk
+    Example : pairwise_distances_sparse(.load_cpg_matrix() output,"man_dist_scaled")
+    Returns N x N array of distances or the filled output
+    """
+    print("Running : Pairwise distances from CpG matrix")
+    t0 = time.time()
+    cell_count=len(cpg_matrix['samples'])
+    distances=np.zeros((cell_count,cell_count)) if output is None else None
+    for x in range(0,cell_count,block_size):
+        rows=np.arange(x,min(x+block_size,cell_count))
+        block=distances_from_counts(*pairwise_counts_sparse(cpg_matrix,rows,np.arange(cell_count)),difference_type)
+        if output is not None:
+            write_distance_block(output,((rows[0],rows[-1]+1),(0,cell_count)),block)
+        else:
+            distances[rows,:]=block
+    print(time.time()-t0)
+    if output is not None:
+        output['matrix'].flush()
+        return(output)
+    return(distances)
+
+############################################################
+def pairwise_frame(samples,distances,difference_type):
+    """
+    Function converts a square distance array into the long form output of .pool_pairwise_combination()
+    Pairs follow itertools.combinations_with_replacement order followed by the swapped half
+    Example : pairwise_frame(["SampleA","SampleB"],distance_array,"man_dist_scaled")
+    Returns Dataframe of pairwise distances
+    """
+    samples=np.asarray(samples,dtype=object)
+    row,col=np.triu_indices(len(samples))
+    results=pd.DataFrame({0:samples[row],1:samples[col],2:np.asarray(distances)[row,col]})
+    pairwise_other_half = results[[1,0,2]]
+    pairwise_other_half.columns = [0,1,2]
+    pairwise_df=pd.concat([results,pairwise_other_half])
+    pairwise_df= pairwise_df.rename(columns={0:'sample_1',1:'sample_2',2:difference_type})
+    return(pairwise_df)
+############################################################
+def pack_bits(positions,length):
+    """
+    Function packs CpG index positions into a little endian uint64 bitset
+    Example : pack_bits([0,5,64],28000000)
+    Returns uint64 array of ceil(length/64) words
+    """
+    words=(length+63)//64
+    bits=np.zeros(words*64,dtype=bool)
+    bits[positions]=True
+    return(np.packbits(bits,bitorder='little').view('<u8'))
+
+############################################################
+def popcount(words):
+    """
+    Function counts set bits of uint64 bitsets along the last axis
+    Returns int64 counts
+    """
+    if hasattr(np,'bitwise_count'):
+        return(np.bitwise_count(words).sum(axis=-1,dtype=np.int64))
+    table=np.array([bin(x).count("1") for x in range(256)],dtype=np.uint8)
+    words=np.ascontiguousarray(words)
+    return(table[words.view(np.uint8)].sum(axis=-1,dtype=np.int64))
+
+############################################################
+def load_cpg_bitsets(cpgs,chr_list,core_count=4,cpg_index=None):
+    """
+    Function parses each single cell CpG file once into bit-packed covered and methylated bitsets
+    Bits follow a genome wide CpG index (.load_reference_cpgs() output) or the union of the cells' CpGs
+    Example : load_cpg_bitsets(["SampleA","SampleB"],["chr1","chr2"],4,.load_reference_cpgs() output)
+    Returns dictionary of samples, CpG keys, covered and methylated uint64 arrays (cells x words)
+    """
+    print("Running : Loading CpG bitsets")
+    t0 = time.time()
+    pool = mp.Pool(core_count)
+    parsed=pool.imap(functools.partial(read_fractional_methylation,chr_list=chr_list),cpgs)
+    if cpg_index is None:
+        parsed=list(parsed)
+        cpg_index=np.unique(np.concatenate([keys for keys,meth in parsed]))
+
+    words=(len(cpg_index)+63)//64
+    cell_bitsets={}
+    cell_bitsets['samples']=list(cpgs)
+    cell_bitsets['cpg_index']=cpg_index
+    cell_bitsets['covered']=np.zeros((len(cpgs),words),dtype=np.uint64)
+    cell_bitsets['methylated']=np.zeros((len(cpgs),words),dtype=np.uint64)
+    for num,(keys,meth) in enumerate(parsed):
+        idx,found=cpg_positions(cpg_index,keys)
+        cell_bitsets['covered'][num]=pack_bits(idx[found],len(cpg_index))
+        cell_bitsets['methylated'][num]=pack_bits(idx[found][meth[found]==1],len(cpg_index))
+    pool.close()
+    del pool
+    print(time.time()-t0)
+    return(cell_bitsets)
+
+############################################################
+def save_cpg_bitsets(cell_bitsets,path,chr_list):
+    """
+    Function saves a .load_cpg_bitsets() output so later runs adding cells need not re-parse the existing cells
+    Example : save_cpg_bitsets(.load_cpg_bitsets() output,"/out_dir/results/JOB_bitsets.npz",["chr1","chr2"])
+    """
+    atomic_write(path,lambda f : np.savez(f,
+                                          samples=np.asarray(cell_bitsets['samples'],dtype=str),
+                                          chr_list=np.asarray(chr_list,dtype=str),
+                                          cpg_index=cell_bitsets['cpg_index'],
+                                          covered=cell_bitsets['covered'],
+                                          methylated=cell_bitsets['methylated']))
+
+def load_saved_bitsets(path,cpgs,chr_list,cpg_index=None):
+    """
+    Function reads the bitsets of cpgs (matched by sample name) from a .save_cpg_bitsets() file
+    Returns .load_cpg_bitsets() output, or None if the file is missing, holds other chromosomes or CpG index or misses cells
+    """
+    if path is None or not os.path.isfile(path):
+        return(None)
+    with np.load(path,allow_pickle=False) as saved:
+        if saved['chr_list'].tolist()!=list(chr_list):
+            return(None)
+        if cpg_index is not None and not np.array_equal(saved['cpg_index'],cpg_index):
+            return(None)
+        positions=dict(zip([sample_name(x) for x in saved['samples']],range(0,len(saved['samples']))))
+        if any(sample_name(x) not in positions for x in cpgs):
+            return(None)
+        rows=np.array([positions[sample_name(x)] for x in cpgs],dtype=np.int64)
+        cell_bitsets={}
+        cell_bitsets['samples']=list(cpgs)
+        cell_bitsets['cpg_index']=saved['cpg_index']
+        cell_bitsets['covered']=saved['covered'][rows]
+        cell_bitsets['methylated']=saved['methylated'][rows]
+    return(cell_bitsets)
+
+def reindex_bitsets(cell_bitsets,cpg_index):
+    """
+    Function moves bitsets onto cpg_index, a superset of their own CpG index
+    Returns .load_cpg_bitsets() output over cpg_index
+    """
+    if len(cell_bitsets['cpg_index'])==len(cpg_index):
+        return(cell_bitsets)
+    positions=np.searchsorted(cpg_index,cell_bitsets['cpg_index'])
+    words=(len(cpg_index)+63)//64
+    reindexed=dict(cell_bitsets,cpg_index=cpg_index)
+    for key in ['covered','methylated']:
+        reindexed[key]=np.zeros((len(cell_bitsets['samples']),words),dtype=np.uint64)
+        for num in range(0,len(cell_bitsets['samples'])):
+            bits=np.unpackbits(np.ascontiguousarray(cell_bitsets[key][num]).view(np.uint8),bitorder='little')
+            reindexed[key][num]=pack_bits(positions[np.flatnonzero(bits[:len(positions)])],len(cpg_index))
+    return(reindexed)
+
+def extend_cpg_bitsets(bitset_file,old_cells,new_cells,chr_list,core_count=4,cpg_index=None):
+    """
+    Function combines the saved bitsets of old_cells (.save_cpg_bitsets()) with bitsets parsed from new_cells' CpG files only
+    Without cpg_index both are moved onto the union of their CpGs; every cell is parsed if the saved bitsets cannot be used
+    Example : extend_cpg_bitsets("/out_dir/results/JOB_bitsets.npz",old_cells,new_cells,["chr1","chr2"],16)
+    Returns .load_cpg_bitsets() output of old_cells followed by new_cells
+    """
+    saved=load_saved_bitsets(bitset_file,old_cells,chr_list,cpg_index)
+    if saved is None:
+        print("Saved bitsets do not cover the existing cells, parsing every CpG file")
+        return(load_cpg_bitsets(list(old_cells)+list(new_cells),chr_list,core_count,cpg_index))
+    new_bitsets=load_cpg_bitsets(new_cells,chr_list,core_count,cpg_index)
+    merged_index=saved['cpg_index'] if cpg_index is not None else np.union1d(saved['cpg_index'],new_bitsets['cpg_index'])
+    saved=reindex_bitsets(saved,merged_index)
+    new_bitsets=reindex_bitsets(new_bitsets,merged_index)
+    cell_bitsets={}
+    cell_bitsets['samples']=list(old_cells)+list(new_cells)
+    cell_bitsets['cpg_index']=merged_index
+    cell_bitsets['covered']=np.concatenate([saved['covered'],new_bitsets['covered']])
+    cell_bitsets['methylated']=np.concatenate([saved['methylated'],new_bitsets['methylated']])
+    return(cell_bitsets)
+
+############################################################
+def bitset_counts(covered_x,methylated_x,covered_y,methylated_y):
+    """
+    Function computes shared CpG counts between bitsets via AND/XOR/popcount
+    Inputs broadcast, i.e. one cell (words) against a block of cells (cells x words)
+    Returns shared, meth_x, meth_y and meth_xy counts
+    """
+    shared=covered_x&covered_y
+    return(
+        popcount(shared),
+        popcount(methylated_x&covered_y),
+        popcount(covered_x&methylated_y),
+        popcount(methylated_x&methylated_y)
+    )
+
+############################################################
+def pairwise_distances_bitset(cell_bitsets,difference_type,chunk_words=2**23):
+    """
+    Function computes all pairwise distances from a .load_cpg_bitsets() output
+    Each cell is compared against blocks of partners sized to chunk_words uint64 words
+    Example : pairwise_distances_bitset(.load_cpg_bitsets() output,"man_dist_scaled")
+    Returns N x N array of distances
+    """
+    print("Running : Pairwise distances from CpG bitsets")
+    t0 = time.time()
+    covered=cell_bitsets['covered']
+    methylated=cell_bitsets['methylated']
+    cell_count,words=covered.shape
+    block_size=max(1,chunk_words//max(words,1))
+    distances=np.zeros((cell_count,cell_count))
+    for x in range(0,cell_count):
+        for y in range(x,cell_count,block_size):
+            cols=slice(y,min(y+block_size,cell_count))
+            distances[x,cols]=distances_from_counts(
+                *bitset_counts(covered[x],methylated[x],covered[cols],methylated[cols]),difference_type)
+            distances[cols,x]=distances[x,cols]
+    print(time.time()-t0)
+    return(distances)
+############################################################
+def tile_pairs(cell_count,tile_size=64,rows=None):
+    """
+    Function splits the N x N pairwise matrix into upper triangular tiles of tile_size cells
+    rows restricts tiles to row blocks starting at rows[0] (all columns), as used for new cells
+    Example : tile_pairs(1000,64)
+    Returns list of ((row_start,row_stop),(col_start,col_stop)) tiles
+    """
+    blocks=[(x,min(x+tile_size,cell_count)) for x in range(0,cell_count,tile_size)]
+    if rows is None:
+        return([(row,col) for num,row in enumerate(blocks) for col in blocks[num:]])
+    row_blocks=[(x,min(x+tile_size,rows[1])) for x in range(rows[0],rows[1],tile_size)]
+    return([(row,col) for row in row_blocks for col in blocks])
+
+############################################################
+###Worker side bitsets set by .attach_bitsets()
+shared_bitsets = {}
+
+def share_bitsets(cell_bitsets):
+    """
+    Function places covered/methylated bitsets into shared memory so pool workers attach without pickled copies
+    Returns descriptors for .attach_bitsets() and handles for .release_bitsets()
+    """
+    descriptors={}
+    handles=[]
+    for key in ['covered','methylated']:
+        array=cell_bitsets[key]
+        if shared_memory is not None:
+            shm=shared_memory.SharedMemory(create=True,size=max(array.nbytes,1))
+            np.ndarray(array.shape,dtype=array.dtype,buffer=shm.buf)[:]=array
+            descriptors[key]=('shm',shm.name,array.shape)
+            handles.append(shm)
+        else:
+            tmp_dir=tempfile.mkdtemp()
+            np.save(tmp_dir+"/"+key+".npy",array)
+            descriptors[key]=('npy',tmp_dir+"/"+key+".npy",array.shape)
+            handles.append(tmp_dir)
+    return(descriptors,handles)
+
+def attach_bitsets(descriptors):
+    """
+    Pool initializer attaching a worker to bitsets published by .share_bitsets()
+    """
+    for key,(kind,name,shape) in descriptors.items():
+        if kind=='shm':
+            try:
+                shm=shared_memory.SharedMemory(name=name,track=False)
+            except TypeError:
+                shm=shared_memory.SharedMemory(name=name)
+            shared_bitsets[key+"_shm"]=shm
+            shared_bitsets[key]=np.ndarray(shape,dtype=np.uint64,buffer=shm.buf)
+        else:
+            shared_bitsets[key]=np.load(name,mmap_mode='r')
+
+def release_bitsets(handles):
+    """
+    Function frees bitsets published by .share_bitsets()
+    """
+    for handle in handles:
+        if isinstance(handle,str):
+            shutil.rmtree(handle,ignore_errors=True)
+        else:
+            handle.close()
+            handle.unlink()
+
+############################################################
+def pairwise_tile(tile,chunk_words=4096):
+    """
+    Function computes shared CpG counts for one tile against bitsets attached by .attach_bitsets()
+    Words are walked in chunks so the row and partner blocks stay cache resident
+    Returns tile and int64 counts array of shape 4 x rows x cols (shared, meth_x, meth_y, meth_xy)
+    """
+    (row_start,row_stop),(col_start,col_stop)=tile
+    covered=shared_bitsets['covered']
+    methylated=shared_bitsets['methylated']
+    counts=np.zeros((4,row_stop-row_start,col_stop-col_start),dtype=np.int64)
+    for x in range(0,covered.shape[1],chunk_words):
+        words=slice(x,x+chunk_words)
+        covered_x=np.ascontiguousarray(covered[row_start:row_stop,words])
+        methylated_x=np.ascontiguousarray(methylated[row_start:row_stop,words])
+        covered_y=np.ascontiguousarray(covered[col_start:col_stop,words])
+        methylated_y=np.ascontiguousarray(methylated[col_start:col_stop,words])
+        for row in range(0,row_stop-row_start):
+            counts[:,row,:]+=np.array(bitset_counts(covered_x[row],methylated_x[row],covered_y,methylated_y))
+    return(tile,counts)
+
+############################################################
+def run_pairwise_tiles(cell_bitsets,core_count,tiles):
+    """
+    Generator scheduling tiles across a process pool attached to shared bitsets
+    Example : for tile,counts in run_pairwise_tiles(.load_cpg_bitsets() output,16,.tile_pairs() output)
+    Yields tiles and their shared CpG counts as they complete
+    """
+    descriptors,handles=share_bitsets(cell_bitsets)
+    pool = mp.Pool(core_count,initializer=attach_bitsets,initargs=(descriptors,))
+    try:
+        for tile,counts in pool.imap_unordered(pairwise_tile,tiles):
+            yield tile,counts
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
+        release_bitsets(handles)
+
+############################################################
+def checkpoint_key(cpgs,difference_type,chr_list,tile_size=None,cpg_index=None):
+    """
+    Function hashes the configuration of a pairwise run (cell set, metric, chromosomes, tiling, reference CpGs)
+    cpg_index (.load_reference_cpgs() output) enters as a sha1 of its keys, so a changed reference never resumes old tiles
+    Example : checkpoint_key(["SampleA","SampleB"],"man_dist_scaled",["chr1","chr2"],64,.load_reference_cpgs() output)
+    Returns configuration dictionary and its sha1 key
+    """
+    config={'cells':list(cpgs),'difference_type':difference_type,'chr_list':list(chr_list),'tile_size':tile_size,
+            'cpg_index':None if cpg_index is None else hashlib.sha1(np.ascontiguousarray(cpg_index,dtype=np.int64)).hexdigest()}
+    return(config,hashlib.sha1(json.dumps(config,sort_keys=True).encode()).hexdigest())
+
+def atomic_write(path,write,mode="wb"):
+    """
+    Function writes path through a temporary file renamed into place so readers never see partial files
+    Example : atomic_write("/out_dir/results/x.npy",lambda f : np.save(f,array))
+    """
+    tmp_path=path+".tmp"+str(os.getpid())
+    with open(tmp_path,mode) as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path,path)
+
+############################################################
+def tile_name(tile):
+    (row_start,row_stop),(col_start,col_stop)=tile
+    return("tile_"+"_".join(str(x) for x in [row_start,row_stop,col_start,col_stop]))
+
+def open_checkpoint(checkpoint_dir,config,key):
+    """
+    Function opens (or creates) a tile checkpoint directory holding manifest.json, completed.log and per-tile counts
+    A manifest from a different configuration is discarded together with its tiles
+    Returns set of completed tile names
+    """
+    os.makedirs(checkpoint_dir,exist_ok=True)
+    manifest_file=checkpoint_dir+"/manifest.json"
+    if os.path.isfile(manifest_file):
+        with open(manifest_file) as f:
+            manifest=json.load(f)
+        if manifest['key']!=key:
+            print("WARNING: "+checkpoint_dir+" belongs to another configuration. Restarting checkpoint")
+            for x in glob.glob(checkpoint_dir+"/tile_*.npy")+[checkpoint_dir+"/completed.log"]:
+                os.remove(x)
+    atomic_write(manifest_file,lambda f : f.write(json.dumps({'key':key,'config':config})),mode="w")
+    return(completed_tiles(checkpoint_dir))
+
+def completed_tiles(checkpoint_dir,key=None):
+    """
+    Function reads the completed tiles of a checkpoint directory without modifying it
+    With key, a checkpoint of another configuration (or none at all) has no completed tiles
+    Returns set of completed tile names
+    """
+    completed=set()
+    if key is not None:
+        if not os.path.isfile(checkpoint_dir+"/manifest.json"):
+            return(completed)
+        with open(checkpoint_dir+"/manifest.json") as f:
+            if json.load(f)['key']!=key:
+                return(completed)
+    if os.path.isfile(checkpoint_dir+"/completed.log"):
+        with open(checkpoint_dir+"/completed.log") as f:
+            for line in f:
+                ### Ignore torn trailing records and tiles whose counts are gone
+                if line.endswith("\n") and os.path.isfile(checkpoint_dir+"/"+line.strip()+".npy"):
+                    completed.add(line.strip())
+    return(completed)
+
+def record_tile(checkpoint_dir,tile,block):
+    """
+    Function atomically saves a tile's float32 distances then appends its completion record
+    """
+    atomic_write(checkpoint_dir+"/"+tile_name(tile)+".npy",lambda f : np.save(f,block.astype(np.float32)))
+    with open(checkpoint_dir+"/completed.log","a") as f:
+        f.write(tile_name(tile)+"\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+def load_tile(checkpoint_dir,tile,difference_type):
+    """
+    Function reads a tile's distances saved by .record_tile(), converting the 4 x rows x cols counts of older checkpoints
+    """
+    block=np.load(checkpoint_dir+"/"+tile_name(tile)+".npy")
+    if block.ndim==3:
+        return(distances_from_counts(*block,difference_type))
+    return(block)
+
+############################################################
+def pool_pairwise_tiles(cell_bitsets,core_count,difference_type,tile_size=64,checkpoint_dir=None,checkpoint=None,output=None):
+    """
+    Function computes all pairwise distances as tiles of the N x N matrix across core_count workers
+    With checkpoint_dir and checkpoint (.checkpoint_key() output) finished tiles are recorded as float32 distances and skipped
+    on resume; the checkpoint is removed once every tile is in the output
+    With output (.create_distance_memmap() output) tiles are written straight to disk
+    Example : pool_pairwise_tiles(.load_cpg_bitsets() output,16,"man_dist_scaled",64)
+    Returns N x N array of distances or the filled output
+    """
+    print("Running : Pairwise distances in tiles")
+    t0 = time.time()
+    cell_count=len(cell_bitsets['samples'])
+    distances=np.zeros((cell_count,cell_count)) if output is None else None
+    tiles=tile_pairs(cell_count,tile_size)
+    completed=set()
+    if checkpoint_dir is not None:
+        completed=open_checkpoint(checkpoint_dir,*checkpoint)
+        print("Resuming : "+str(len(completed))+" of "+str(len(tiles))+" tiles complete")
+
+    def fill(tile,block):
+        (row_start,row_stop),(col_start,col_stop)=tile
+        if output is not None:
+            write_distance_block(output,tile,block)
+            return
+        distances[row_start:row_stop,col_start:col_stop]=block
+        distances[col_start:col_stop,row_start:row_stop]=block.T
+
+    for tile in tiles:
+        if tile_name(tile) in completed:
+            fill(tile,load_tile(checkpoint_dir,tile,difference_type))
+    tiles_to_run=[tile for tile in tiles if tile_name(tile) not in completed]
+    if len(tiles_to_run)>0:
+        for tile,counts in run_pairwise_tiles(cell_bitsets,core_count,tiles_to_run):
+            block=distances_from_counts(*counts,difference_type)
+            if checkpoint_dir is not None:
+                record_tile(checkpoint_dir,tile,block)
+            fill(tile,block)
+    if output is not None:
+        output['matrix'].flush()
+    if checkpoint_dir is not None:
+        ###Every tile is in the output, the checkpoint is no longer needed
+        shutil.rmtree(checkpoint_dir,ignore_errors=True)
+    print(time.time()-t0)
+    if output is not None:
+        return(output)
+    return(distances)
+############################################################
+def sample_name(cpg_file):
+    return(cpg_file.split("/")[-1].split(".")[0])
+
+def create_distance_memmap(path,samples,difference_type,layout='square'):
+    """
+    Function creates a disk backed float32 distance matrix with a .json sidecar of its samples
+    Layouts : 'square' (N x N) or 'condensed' (N*(N-1)/2, scipy pdist order)
+    Example : create_distance_memmap("/out_dir/results/JOB_man_dist_scaled.f32",["SampleA","SampleB"],"man_dist_scaled")
+    Returns distance matrix dictionary
+    """
+    cell_count=len(samples)
+    shape=(cell_count,cell_count) if layout=='square' else (cell_count*(cell_count-1)//2,)
+    sidecar={'samples':list(samples),
+             'labels':[sample_name(x) for x in samples],
+             'difference_type':difference_type,
+             'layout':layout,
+             'shape':list(shape),
+             'dtype':'float32'}
+    atomic_write(path+".json",lambda f : f.write(json.dumps(sidecar)),mode="w")
+    matrix=np.memmap(path,dtype=np.float32,mode='w+',shape=shape)
+    return(dict(sidecar,path=path,matrix=matrix,index=None))
+
+def open_distance_matrix(path,mode='r'):
+    """
+    Function opens a distance matrix written by .create_distance_memmap()
+    Example : open_distance_matrix("/out_dir/results/JOB_man_dist_scaled.f32")
+    Returns distance matrix dictionary
+    """
+    with open(path+".json") as f:
+        sidecar=json.load(f)
+    matrix=np.memmap(path,dtype=np.float32,mode=mode,shape=tuple(sidecar['shape']))
+    return(dict(sidecar,path=path,matrix=matrix,index=None))
+
+def subset_distance_matrix(dist_matrix,labels):
+    """
+    Function restricts a distance matrix dictionary to labels (sample names) without reading it
+    Example : subset_distance_matrix(.open_distance_matrix() output,QC_samples)
+    Returns distance matrix dictionary
+    """
+    positions=dict(zip(dist_matrix['labels'],range(0,len(dist_matrix['labels']))))
+    index=np.array([positions[x] for x in labels],dtype=np.int64)
+    if dist_matrix['index'] is not None:
+        index=dist_matrix['index'][index]
+    return(dict(dist_matrix,index=index,labels=list(labels)))
+
+def condensed_index(cell_count,row,col):
+    """
+    Function maps pairs row<col to positions of a condensed (pdist order) distance vector
+    """
+    return(cell_count*row-row*(row+1)//2+(col-row-1))
+
+def write_distance_block(dist_matrix,tile,block):
+    """
+    Function writes a tile of distances (and its mirror) into a distance matrix dictionary
+    """
+    (row_start,row_stop),(col_start,col_stop)=tile
+    matrix=dist_matrix['matrix']
+    if dist_matrix['layout']=='square':
+        matrix[row_start:row_stop,col_start:col_stop]=block
+        matrix[col_start:col_stop,row_start:row_stop]=block.T
+        return
+    rows,cols=np.meshgrid(np.arange(row_start,row_stop),np.arange(col_start,col_stop),indexing='ij')
+    off_diagonal=rows!=cols
+    positions=condensed_index(len(dist_matrix['samples']),
+                              np.minimum(rows,cols)[off_diagonal],
+                              np.maximum(rows,cols)[off_diagonal])
+    matrix[positions]=block[off_diagonal]
+
+def read_distance_block(dist_matrix,rows,cols):
+    """
+    Function reads distances between positions rows and cols (of the full matrix) from a distance matrix dictionary
+    Condensed layouts are expanded one row at a time, so no index array beyond len(cols) is built
+    Returns rows x cols float32 array
+    """
+    rows=np.asarray(rows,dtype=np.int64)
+    cols=np.asarray(cols,dtype=np.int64)
+    matrix=dist_matrix['matrix']
+    if dist_matrix['layout']=='square':
+        return(np.asarray(matrix[np.ix_(rows,cols)]))
+    cell_count=len(dist_matrix['samples'])
+    block=np.zeros((len(rows),len(cols)),dtype=np.float32)
+    for num,row in enumerate(rows):
+        off_diagonal=cols!=row
+        col=cols[off_diagonal]
+        block[num,off_diagonal]=matrix[condensed_index(cell_count,np.minimum(col,row),np.maximum(col,row))]
+    return(block)
+
+def distance_matrix_values(pairwise_array):
+    """
+    Function returns labels and a square array for a pivoted pairwise DataFrame or a distance matrix dictionary
+    Whole square memmaps are returned as is, without copying into memory
+    Example : distance_matrix_values(.open_distance_matrix() output)
+    Returns list of labels and square array
+    """
+    if isinstance(pairwise_array,pd.DataFrame):
+        return(pairwise_array.columns.tolist(),pairwise_array.values)
+    index=pairwise_array['index']
+    if pairwise_array['layout']=='square' and index is None:
+        return(pairwise_array['labels'],pairwise_array['matrix'])
+    if index is None:
+        index=np.arange(0,len(pairwise_array['samples']))
+    return(pairwise_array['labels'],read_distance_block(pairwise_array,index,index))
+############################################################
+def hash_cpg_keys(keys,seed=0):
+    """
+    Function hashes CpG keys with splitmix64 so every cell samples the same genome wide CpGs
+    Returns uint64 hashes
+    """
+    with np.errstate(over='ignore'):
+        z=np.asarray(keys,dtype=np.int64).astype(np.uint64)+np.uint64(seed+1)*np.uint64(0x9E3779B97F4A7C15)
+        z=(z^(z>>np.uint64(30)))*np.uint64(0xBF58476D1CE4E5B9)
+        z=(z^(z>>np.uint64(27)))*np.uint64(0x94D049BB133111EB)
+    return(z^(z>>np.uint64(31)))
+
+def sketch_cpg_matrix(cpg_matrix,sketch_size=50000,seed=0):
+    """
+    Function sketches a .load_cpg_matrix() output by keeping CpGs whose hash falls below a shared threshold
+    The threshold is set so the median cell keeps sketch_size CpGs; pairs are sampled at the same rate
+    Example : sketch_cpg_matrix(.load_cpg_matrix() output,50000)
+    Returns CpG matrix dictionary of the sketched CpGs with its sampling_rate
+    """
+    coverage=cpg_matrix['coverage']
+    rate=min(1.0,sketch_size/max(np.median(np.diff(coverage.indptr)),1))
+    keep=np.flatnonzero(hash_cpg_keys(cpg_matrix['cpg_index'],seed)<=np.uint64(min(int(rate*2**64),2**64-1)))
+    sketch={}
+    sketch['samples']=cpg_matrix['samples']
+    sketch['cpg_index']=cpg_matrix['cpg_index'][keep]
+    sketch['coverage']=coverage[:,keep]
+    sketch['methylation']=cpg_matrix['methylation'][:,keep]
+    sketch['sampling_rate']=rate
+    return(sketch)
+
+def sketch_counts(sketch,rows,cols):
+    """
+    Function estimates shared CpG counts of the full matrix from a .sketch_cpg_matrix() output
+    Returns estimated shared, meth_x, meth_y and meth_xy arrays
+    """
+    return([x/sketch['sampling_rate'] for x in pairwise_counts_sparse(sketch,rows,cols)])
+
+############################################################
+def sketch_benchmark(cpg_matrix,sketch,difference_type,benchmark_cells=50,candidates=15,seed=0):
+    """
+    Function compares sketch estimates against exact distances on a random subset of cells
+    Example : sketch_benchmark(.load_cpg_matrix() output,.sketch_cpg_matrix() output,"man_dist_scaled")
+    Returns single row Dataframe of absolute distance errors, shared CpG relative error and nearest neighbour recall
+    """
+    cell_count=len(cpg_matrix['samples'])
+    subset=np.sort(np.random.RandomState(seed).choice(cell_count,min(benchmark_cells,cell_count),replace=False))
+    exact_counts=pairwise_counts_sparse(cpg_matrix,subset,subset)
+    approx_counts=sketch_counts(sketch,subset,subset)
+    exact=distances_from_counts(*exact_counts,difference_type)
+    approx=distances_from_counts(*approx_counts,difference_type)
+    off_diagonal=~np.eye(len(subset),dtype=bool)
+    valid=off_diagonal&np.isfinite(exact)&np.isfinite(approx)
+    error=np.abs(exact-approx)[valid]
+    with np.errstate(divide='ignore',invalid='ignore'):
+        shared_error=(np.abs(exact_counts[0]-approx_counts[0])/exact_counts[0])[off_diagonal&(exact_counts[0]>0)]
+
+    recall=np.nan
+    neighbours=min(candidates,len(subset)-1)
+    if neighbours>0:
+        exact_ranked=np.where(off_diagonal&np.isfinite(exact),exact,np.inf)
+        approx_ranked=np.where(off_diagonal&np.isfinite(approx),approx,np.inf)
+        exact_knn=np.argsort(exact_ranked,axis=1,kind='stable')[:,:neighbours]
+        approx_knn=np.argsort(approx_ranked,axis=1,kind='stable')[:,:neighbours]
+        recall=np.mean([len(np.intersect1d(x,y))/neighbours for x,y in zip(exact_knn,approx_knn)])
+
+    report=pd.DataFrame({
+        'cells':[len(subset)],
+        'sampling_rate':[sketch['sampling_rate']],
+        'mean_abs_error':[error.mean() if len(error)>0 else np.nan],
+        'median_abs_error':[np.median(error) if len(error)>0 else np.nan],
+        'max_abs_error':[error.max() if len(error)>0 else np.nan],
+        'median_shared_rel_error':[np.median(shared_error) if len(shared_error)>0 else np.nan],
+        'knn_recall':[recall]
+    })
+    return(report)
+
+############################################################
+def pairwise_distances_sketch(cpg_matrix,difference_type,sketch_size=50000,candidates=15,block_size=256,seed=0):
+    """
+    Function estimates all pairwise distances from CpG sketches, then recomputes exactly each cell's nearest candidates
+    Example : pairwise_distances_sketch(.load_cpg_matrix() output,"man_dist_scaled",50000,15)
+    Returns N x N array of distances (exact for self and candidate pairs, estimated elsewhere) and the sketch
+    """
+    print("Running : Sketch pairwise distances")
+    t0 = time.time()
+    sketch=sketch_cpg_matrix(cpg_matrix,sketch_size,seed)
+    cell_count=len(cpg_matrix['samples'])
+    all_cells=np.arange(cell_count)
+    neighbours=min(candidates,cell_count-1)
+    distances=np.zeros((cell_count,cell_count))
+    blocks=[]
+    for x in range(0,cell_count,block_size):
+        rows=np.arange(x,min(x+block_size,cell_count))
+        approx=distances_from_counts(*sketch_counts(sketch,rows,all_cells),difference_type)
+        distances[rows,:]=approx
+        if neighbours<1:
+            continue
+        ###Candidates are the nearest estimates excluding self and pairs without shared CpGs
+        ranked=np.where(np.isfinite(approx),approx,np.inf)
+        ranked[np.arange(len(rows)),rows]=np.inf
+        blocks.append((rows,np.argpartition(ranked,neighbours-1,axis=1)[:,:neighbours]))
+    ###Refinement runs once every row holds its estimates, so mirrored exact values are never overwritten
+    for rows,nearest in blocks:
+        cols=np.unique(nearest)
+        exact=distances_from_counts(*pairwise_counts_sparse(cpg_matrix,rows,cols),difference_type)
+        refined=exact[np.arange(len(rows))[:,None],np.searchsorted(cols,nearest)]
+        distances[rows[:,None],nearest]=refined
+        distances[nearest,rows[:,None]]=refined
+    ###Self distances are exact
+    coverage=np.diff(cpg_matrix['coverage'].indptr)
+    methylated=np.asarray(cpg_matrix['methylation'].sum(axis=1)).ravel()
+    distances[all_cells,all_cells]=distances_from_counts(coverage,methylated,methylated,methylated,difference_type)
+    print(time.time()-t0)
+    return(distances,sketch)
+############################################################
+def merge_knn(knn,rows,cols,block_distances,block_shared):
+    """
+    Function merges a block of distances into the running k smallest distances of rows
+    Self pairs and pairs without a defined distance are never neighbours
+    """
+    k=knn['index'].shape[1]
+    ranked=np.where(np.isfinite(block_distances),block_distances,np.inf)
+    ranked[rows[:,None]==cols[None,:]]=np.inf
+    distances=np.concatenate([knn['distance'][rows],ranked],axis=1)
+    index=np.concatenate([knn['index'][rows],np.broadcast_to(cols,ranked.shape)],axis=1)
+    shared=np.concatenate([knn['shared'][rows],block_shared],axis=1)
+    keep=np.argpartition(distances,k-1,axis=1)[:,:k] if distances.shape[1]>k else np.argsort(distances,axis=1)
+    order=np.arange(len(rows))[:,None]
+    knn['distance'][rows]=distances[order,keep]
+    knn['index'][rows]=index[order,keep]
+    knn['shared'][rows]=shared[order,keep]
+
+def knn_graph(knn,samples):
+    """
+    Function converts running neighbour arrays into sparse graphs
+    Returns dictionary of samples, labels, distances and shared CpG counts as N x N CSR matrices (k entries per row)
+    """
+    cell_count=len(samples)
+    found=np.isfinite(knn['distance'])&(knn['index']>=0)
+    rows=np.broadcast_to(np.arange(cell_count)[:,None],found.shape)[found]
+    graph={}
+    graph['samples']=list(samples)
+    graph['labels']=[sample_name(x) for x in samples]
+    ###Zero distances are stored explicitly, every stored entry is a neighbour
+    graph['distances']=sci.sparse.csr_matrix(
+        (knn['distance'][found],(rows,knn['index'][found])),shape=(cell_count,cell_count))
+    graph['shared']=sci.sparse.csr_matrix(
+        (knn['shared'][found],(rows,knn['index'][found])),shape=(cell_count,cell_count))
+    return(graph)
+
+############################################################
+def pool_pairwise_knn(cpgs,core_count,chr_list,difference_type,k=15,reference_cpgs=None,tile_size=64):
+    """
+    Wrapper computing a k nearest neighbour graph of single cells instead of all N x N distances
+    Tiles are computed as in pool_pairwise_combination(mode='tiled') and folded into running k smallest distances,
+    so memory beyond the bitsets stays O(N*k)
+    Example : pool_pairwise_knn(["SampleA","SampleB"],4,["chr1","chr2"],"man_dist_scaled",15)
+    Returns dictionary of samples, labels, distances and shared CpG count CSR matrices
+    """
+    print("Running : Pairwise nearest neighbour graph")
+    t0 = time.time()
+    cpg_index=None if reference_cpgs is None else load_reference_cpgs(reference_cpgs,chr_list)
+    cell_bitsets=load_cpg_bitsets(cpgs,chr_list,core_count,cpg_index)
+    cell_count=len(cpgs)
+    k=min(k,max(cell_count-1,1))
+    knn={'distance':np.full((cell_count,k),np.inf),
+         'index':np.full((cell_count,k),-1,dtype=np.int64),
+         'shared':np.zeros((cell_count,k))}
+    for ((row_start,row_stop),(col_start,col_stop)),counts in run_pairwise_tiles(
+            cell_bitsets,core_count,tile_pairs(cell_count,tile_size)):
+        rows=np.arange(row_start,row_stop)
+        cols=np.arange(col_start,col_stop)
+        block=distances_from_counts(*counts,difference_type)
+        merge_knn(knn,rows,cols,block,counts[0])
+        if row_start!=col_start:
+            merge_knn(knn,cols,rows,block.T,counts[0].T)
+    del cell_bitsets
+    graph=knn_graph(knn,cpgs)
+    print(time.time()-t0)
+    return(graph)
+############################################################
+def read_region_counts(cpg_file,chr_list,window_size=100000,regions=None):
+    """
+    Function sums a .fractional_methylation.bed.gz's methylated/unmethylated counts per genomic window or region
+    regions holds sorted region start keys and ends (.region_index() output); CpGs outside regions are dropped
+    Returns region keys (or indices into regions) and methylated/unmethylated sums
+    """
+    cpg=pd.read_csv(cpg_file,
+                    compression='gzip',
+                    sep="\t",
+                    header=None,
+                    names=['chr','start','stop','A','B','C','meth'],
+                    usecols=['chr','start','A','B'],
+                    dtype={'chr':object,'start':np.int64,'A':float,'B':float})
+    keys,keep=cpg_keys(cpg['chr'].values,cpg['start'].values,chr_list)
+    methylated=cpg['A'].fillna(0.0).values[keep]
+    unmethylated=cpg['B'].fillna(0.0).values[keep]
+    keys=keys[keep]
+    del cpg
+    if regions is None:
+        ###Window keys keep the chromosome index in the upper 32 bits
+        ids=((keys>>32)<<32)|((keys&0xFFFFFFFF)//window_size)
+    else:
+        region_keys,region_ends=regions
+        ids=np.searchsorted(region_keys,keys,side='right')-1
+        inside=(ids>=0)
+        inside[inside]=((region_keys[ids[inside]]>>32)==(keys[inside]>>32))&(keys[inside]<region_ends[ids[inside]])
+        ids=ids[inside]
+        methylated=methylated[inside]
+        unmethylated=unmethylated[inside]
+    ids,inverse=np.unique(ids,return_inverse=True)
+    return(ids,
+           np.bincount(inverse,weights=methylated,minlength=len(ids)),
+           np.bincount(inverse,weights=unmethylated,minlength=len(ids)))
+
+def region_index(regions,chr_list):
+    """
+    Function prepares a BED file or Dataframe (chr,start,end) of non-overlapping regions for .read_region_counts()
+    Returns Dataframe of regions on chr_list sorted by position, region start keys and region ends
+    """
+    if isinstance(regions,str):
+        regions=pd.read_csv(regions,sep='\t',header=None,usecols=[0,1,2],names=['chr','start','end'],
+                            dtype={'chr':object,'start':np.int64,'end':np.int64},comment='#',
+                            compression='gzip' if regions.endswith(".gz") else None)
+    regions=regions.loc[:,['chr','start','end']].copy()
+    keys,keep=cpg_keys(regions['chr'].values,regions['start'].values,chr_list)
+    order=np.argsort(keys[keep],kind='stable')
+    regions=regions.loc[keep].iloc[order].reset_index(drop=True)
+    keys=keys[keep][order]
+    return(regions,keys,(keys&~np.int64(0xFFFFFFFF))|regions['end'].values.astype(np.int64))
+
+############################################################
+def window_methylation_features(cpgs,chr_list,window_size=100000,regions=None,core_count=4,min_coverage=1):
+    """
+    Function aggregates each cell's methylated/unmethylated CpG counts into fixed genomic windows or supplied regions
+    regions may be a BED path or Dataframe (chr,start,end) of non-overlapping regions (promoters, CpG islands)
+    Regions with less than min_coverage reads are missing (NaN) in fraction
+    Example : window_methylation_features(["SampleA","SampleB"],["chr1","chr2"],100000)
+    Returns dictionary of samples, labels, regions Dataframe and dense cells x regions float32 methylated, unmethylated and fraction
+    """
+    print("Running : Aggregating methylation into regions")
+    t0 = time.time()
+    region_keys=None
+    if regions is not None:
+        regions,start_keys,end_keys=region_index(regions,chr_list)
+        region_keys=(start_keys,end_keys)
+    pool = mp.Pool(core_count)
+    parsed=pool.map(functools.partial(read_region_counts,chr_list=chr_list,window_size=window_size,regions=region_keys),cpgs)
+    pool.close()
+    del pool
+
+    if regions is None:
+        ids=np.unique(np.concatenate([x[0] for x in parsed]))
+        regions=pd.DataFrame({'chr':np.asarray(chr_list,dtype=object)[ids>>32],
+                              'start':(ids&0xFFFFFFFF)*window_size,
+                              'end':((ids&0xFFFFFFFF)+1)*window_size})
+    else:
+        ids=np.arange(0,len(regions))
+    features={}
+    features['samples']=list(cpgs)
+    features['labels']=[sample_name(x) for x in cpgs]
+    features['regions']=regions
+    features['methylated']=np.zeros((len(cpgs),len(ids)),dtype=np.float32)
+    features['unmethylated']=np.zeros((len(cpgs),len(ids)),dtype=np.float32)
+    for num,(cell_ids,methylated,unmethylated) in enumerate(parsed):
+        positions=np.searchsorted(ids,cell_ids)
+        features['methylated'][num,positions]=methylated
+        features['unmethylated'][num,positions]=unmethylated
+    del parsed
+    coverage=features['methylated']+features['unmethylated']
+    with np.errstate(divide='ignore',invalid='ignore'):
+        features['fraction']=np.where(coverage>=max(min_coverage,1),features['methylated']/coverage,np.nan).astype(np.float32)
+    print(time.time()-t0)
+    return(features)
+
+############################################################
+def pairwise_distances_features(features,difference_type):
+    """
+    Function computes pairwise distances between cells over their shared (non-missing) regions
+    Possible distance functions: 'pearson','euclid_dist','man_dist','man_dist_scaled','euclid_dist_scaled'
+    Default : 'man_dist_scaled'
+    Example : pairwise_distances_features(.window_methylation_features() output,"man_dist_scaled")
+    Returns pivoted pairwise Dataframe (labels x labels) as used by plotPairwise_heatmap
+    """
+    print("Running : Pairwise distances from region features")
+    t0 = time.time()
+    if difference_type not in ['pearson','euclid_dist','man_dist','euclid_dist_scaled']:
+        difference_type='man_dist_scaled'
+    ###Products are accumulated in float64 from the float32 features
+    observed=np.isfinite(features['fraction']).astype(np.float64)
+    values=np.nan_to_num(features['fraction']).astype(np.float64)
+    shared=observed@observed.T
+    with np.errstate(divide='ignore',invalid='ignore'):
+        if difference_type in ['man_dist','man_dist_scaled']:
+            distances=np.zeros(shared.shape)
+            for row in range(0,values.shape[0]):
+                distances[row]=(np.abs(values[row]-values)*(observed[row]*observed)).sum(axis=1)
+        else:
+            sum_x=values@observed.T
+            sum_xx=(values**2)@observed.T
+            sum_xy=values@values.T
+            if difference_type=='pearson':
+                covariance=shared*sum_xy-sum_x*sum_x.T
+                variance=(shared*sum_xx-sum_x**2)*(shared*sum_xx.T-sum_x.T**2)
+                distances=1-covariance/np.sqrt(variance)
+            else:
+                distances=np.clip(sum_xx+sum_xx.T-2*sum_xy,0,None)
+        if difference_type in ['man_dist_scaled','euclid_dist_scaled']:
+            distances=distances/shared
+        if difference_type in ['euclid_dist','euclid_dist_scaled']:
+            distances=np.sqrt(distances)
+    print(time.time()-t0)
+    return(pd.DataFrame(distances,index=features['labels'],columns=features['labels']))
+############################################################
+def queue_pairwise_tiles(cpgs,queue_dir,core_count,chr_list,difference_type,tile_size=64,reference_cpgs=None):
+    """
+    Coordinator for multi node pairwise runs over a shared filesystem
+    Writes cell bitsets, manifest.json and one descriptor per unfinished tile into queue_dir/pending
+    Workers on any node then run .run_pairwise_worker(queue_dir) and .assemble_pairwise_tiles(queue_dir) builds the matrix
+    Example : queue_pairwise_tiles(target_df.cpg.values.tolist(),"/out_dir/queue",16,chr_list,"man_dist_scaled")
+    Returns number of queued tiles
+    """
+    print("Running : Queueing pairwise tiles")
+    t0 = time.time()
+    cpg_index=None if reference_cpgs is None else load_reference_cpgs(reference_cpgs,chr_list)
+    config,key=checkpoint_key(cpgs,difference_type,chr_list,tile_size,cpg_index)
+    for x in ['pending','claimed','done','bitsets']:
+        os.makedirs(queue_dir+"/"+x,exist_ok=True)
+    descriptors=None
+    if os.path.isfile(queue_dir+"/manifest.json"):
+        with open(queue_dir+"/manifest.json") as f:
+            manifest=json.load(f)
+        if manifest['key']!=key:
+            print("WARNING: "+queue_dir+" belongs to another configuration. Restarting queue")
+            for x in glob.glob(queue_dir+"/pending/*")+glob.glob(queue_dir+"/claimed/*")+glob.glob(queue_dir+"/done/*"):
+                os.remove(x)
+        elif all(os.path.isfile(name) for kind,name,shape in manifest['bitsets'].values()):
+            ###Requeueing the same configuration keeps the bitsets instead of re-parsing every cell
+            descriptors=manifest['bitsets']
+
+    if descriptors is None:
+        cell_bitsets=load_cpg_bitsets(cpgs,chr_list,core_count,cpg_index)
+        descriptors={}
+        for x in ['covered','methylated']:
+            atomic_write(queue_dir+"/bitsets/"+x+".npy",lambda f : np.save(f,cell_bitsets[x]))
+            descriptors[x]=('npy',queue_dir+"/bitsets/"+x+".npy",list(cell_bitsets[x].shape))
+        del cell_bitsets
+    atomic_write(queue_dir+"/manifest.json",
+                 lambda f : f.write(json.dumps({'key':key,'config':config,'bitsets':descriptors})),mode="w")
+
+    queued=0
+    for tile in tile_pairs(len(cpgs),tile_size):
+        name=tile_name(tile)
+        if os.path.isfile(queue_dir+"/done/"+name+".npy") or glob.glob(queue_dir+"/claimed/"+name+".json*"):
+            continue
+        atomic_write(queue_dir+"/pending/"+name+".json",lambda f : f.write(json.dumps(tile)),mode="w")
+        queued+=1
+    print("Queued "+str(queued)+" tiles")
+    print(time.time()-t0)
+    return(queued)
+
+def claim_tile(queue_dir):
+    """
+    Function claims one pending tile by atomically renaming it into queue_dir/claimed
+    Returns claimed descriptor path and tile, or None when the queue is empty
+    """
+    owner="."+socket.gethostname()+"."+str(os.getpid())
+    for pending in sorted(glob.glob(queue_dir+"/pending/*.json")):
+        claimed=queue_dir+"/claimed/"+os.path.basename(pending)+owner
+        try:
+            os.rename(pending,claimed)
+        except FileNotFoundError:
+            ###Another worker won the rename
+            continue
+        try:
+            os.utime(claimed)
+            with open(claimed) as f:
+                tile=tuple(tuple(x) for x in json.load(f))
+        except FileNotFoundError:
+            ###Requeued by .requeue_stale_tiles() before the claim was stamped, the tile is pending again
+            continue
+        return(claimed,tile)
+    return(None)
+
+def run_pairwise_worker(queue_dir,max_tiles=None):
+    """
+    Worker claiming and computing tiles queued by .queue_pairwise_tiles() until the queue is empty
+    Any number of workers may run on any node sharing queue_dir, e.g.
+    python -c "from pdclust_expanded import *; run_pairwise_worker('/out_dir/queue')"
+    Returns number of tiles computed
+    """
+    with open(queue_dir+"/manifest.json") as f:
+        manifest=json.load(f)
+    attach_bitsets({x:(kind,name,tuple(shape)) for x,(kind,name,shape) in manifest['bitsets'].items()})
+    computed=0
+    while max_tiles is None or computed<max_tiles:
+        claim=claim_tile(queue_dir)
+        if claim is None:
+            break
+        claimed,tile=claim
+        tile,counts=pairwise_tile(tile)
+        atomic_write(queue_dir+"/done/"+tile_name(tile)+".npy",lambda f : np.save(f,counts))
+        try:
+            os.remove(claimed)
+        except FileNotFoundError:
+            ###Requeued as stale while running, the result is already written
+            pass
+        computed+=1
+    return(computed)
+
+def run_pairwise_workers(queue_dir,core_count):
+    """
+    Function starts core_count local workers on queue_dir, i.e. one node's share of a sharded run
+    Returns number of tiles computed
+    """
+    pool = mp.Pool(core_count)
+    computed=pool.map(run_pairwise_worker,[queue_dir]*core_count)
+    pool.close()
+    return(sum(computed))
+
+def requeue_stale_tiles(queue_dir,timeout=3600):
+    """
+    Function returns tiles claimed more than timeout seconds ago without a result (e.g. a lost node) to pending
+    Returns number of requeued tiles
+    """
+    requeued=0
+    for claimed in glob.glob(queue_dir+"/claimed/*.json.*"):
+        name=os.path.basename(claimed).split(".json")[0]
+        try:
+            if time.time()-os.path.getmtime(claimed)<timeout:
+                continue
+            if os.path.isfile(queue_dir+"/done/"+name+".npy"):
+                os.remove(claimed)
+            else:
+                os.rename(claimed,queue_dir+"/pending/"+name+".json")
+                requeued+=1
+        except FileNotFoundError:
+            continue
+    return(requeued)
+
+def assemble_pairwise_tiles(queue_dir,output='frame',matrix_layout='square',directory_path=None,libid=None):
+    """
+    Function assembles the tiles of a finished .queue_pairwise_tiles() run, then removes queue_dir
+    output='frame' returns the .pool_pairwise_combination() Dataframe, output='memmap' fills
+    directory_path/results/<libid>_<difference_type>_<matrix_layout>.f32 (see .create_distance_memmap())
+    Returns pairwise distances, or None while tiles are outstanding
+    """
+    print("Running : Assembling pairwise tiles")
+    t0 = time.time()
+    with open(queue_dir+"/manifest.json") as f:
+        config=json.load(f)['config']
+    cpgs=config['cells']
+    difference_type=config['difference_type']
+    tiles=tile_pairs(len(cpgs),config['tile_size'])
+    missing=[tile for tile in tiles if not os.path.isfile(queue_dir+"/done/"+tile_name(tile)+".npy")]
+    if len(missing)>0:
+        print(str(len(missing))+" of "+str(len(tiles))+" tiles outstanding")
+        return(None)
+    if output=='memmap':
+        distances=create_distance_memmap(directory_path+"/results/"+libid+"_"+difference_type+"_"+matrix_layout+".f32",
+                                         cpgs,difference_type,matrix_layout)
+    else:
+        distances={'layout':'square','samples':cpgs,'matrix':np.zeros((len(cpgs),len(cpgs)))}
+    for tile in tiles:
+        write_distance_block(distances,tile,load_tile(queue_dir+"/done",tile,difference_type))
+    if output=='memmap':
+        distances['matrix'].flush()
+    ###Every tile is assembled, the queue (bitsets and done tiles) is no longer needed
+    shutil.rmtree(queue_dir,ignore_errors=True)
+    print(time.time()-t0)
+    if output=='memmap':
+        return(distances)
+    return(pairwise_frame(cpgs,distances['matrix'],difference_type))
+############################################################
+def existing_distances(existing,difference_type):
+    """
+    Function returns labels and square distances of an earlier .pool_pairwise_combination() result
+    existing may be its long form Dataframe, the pivoted (labels x labels) Dataframe or a distance matrix dictionary
+    Returns list of labels and square array, or None if existing holds another difference_type
+    """
+    if isinstance(existing,dict) and existing['difference_type']!=difference_type:
+        return(None)
+    if isinstance(existing,pd.DataFrame) and 'sample_1' in existing.columns:
+        if difference_type not in existing.columns:
+            return(None)
+        existing=existing\
+        .assign(sample_1 = lambda row : row['sample_1'].map(sample_name))\
+        .assign(sample_2 = lambda row : row['sample_2'].map(sample_name))\
+        .drop_duplicates(subset=['sample_1','sample_2'],keep='first')\
+        .pivot(index='sample_1',columns='sample_2',values=difference_type)
+    return(distance_matrix_values(existing))
+
+def update_pairwise_combination(existing,cpgs,core_count,chr_list,difference_type,directory_path=None,libid=None,reference_cpgs=None,tile_size=64,output='frame',matrix_layout='square'):
+    """
+    Function adds the cells of cpgs missing from existing (matched by sample name) to an earlier pairwise result
+    Only new x old and new x new tiles are computed; old distances are copied. Old cells absent from cpgs are dropped
+    Bitsets saved by the original run (directory_path/results/<libid>_bitsets.npz) spare re-parsing the old cells' CpG files
+    output='memmap' replaces directory_path/results/<libid>_<difference_type>_<matrix_layout>.f32 once complete
+    Example : update_pairwise_combination(.open_distance_matrix() output,target_df.cpg.values.tolist(),16,chr_list,"man_dist_scaled","/out_dir/","JOB",output='memmap')
+    Returns Datafarme of pairwise distances, or distance matrix dictionary for output='memmap'
+    """
+    print("Running : Updating pairwise combinations")
+    t0 = time.time()
+    previous=existing_distances(existing,difference_type)
+    if previous is None:
+        print("WARNING: existing pairwise distances are not "+difference_type+". Halting operations.")
+        return(None)
+    labels,values=previous
+    positions=dict(zip(labels,range(0,len(labels))))
+    old_cells=[x for x in cpgs if sample_name(x) in positions]
+    new_cells=[x for x in cpgs if sample_name(x) not in positions]
+    cells=old_cells+new_cells
+    old_count=len(old_cells)
+    print(str(len(new_cells))+" new cells, "+str(old_count)+" existing cells")
+    if output=='memmap':
+        path=directory_path+"/results/"+libid+"_"+difference_type+"_"+matrix_layout+".f32"
+        dist_matrix=create_distance_memmap(path+".update",cells,difference_type,matrix_layout)
+    else:
+        dist_matrix={'layout':'square','samples':cells,'matrix':np.zeros((len(cells),len(cells)))}
+
+    ###Copy old distances in row blocks
+    old_index=np.array([positions[sample_name(x)] for x in old_cells],dtype=np.int64)
+    for start in range(0,old_count,tile_size):
+        rows=old_index[start:start+tile_size]
+        write_distance_block(dist_matrix,((start,start+len(rows)),(0,old_count)),np.asarray(values[np.ix_(rows,old_index)]))
+
+    if len(new_cells)>0:
+        cpg_index=None if reference_cpgs is None else load_reference_cpgs(reference_cpgs,chr_list)
+        bitset_file=None if directory_path is None else directory_path+"/results/"+libid+"_bitsets.npz"
+        cell_bitsets=extend_cpg_bitsets(bitset_file,old_cells,new_cells,chr_list,core_count,cpg_index)
+        if bitset_file is not None:
+            save_cpg_bitsets(cell_bitsets,bitset_file,chr_list)
+        ###New rows against old columns and the upper half of new columns
+        tiles=[tile for tile in tile_pairs(len(cells),tile_size,rows=(old_count,len(cells)))
+               if tile[1][0]<old_count or tile[1][1]>tile[0][0]]
+        for tile,counts in run_pairwise_tiles(cell_bitsets,core_count,tiles):
+            write_distance_block(dist_matrix,tile,distances_from_counts(*counts,difference_type))
+        del cell_bitsets
+    print(time.time()-t0)
+    if output=='memmap':
+        dist_matrix['matrix'].flush()
+        del dist_matrix
+        os.replace(path+".update.json",path+".json")
+        os.replace(path+".update",path)
+        return(open_distance_matrix(path))
+    return(pairwise_frame(cells,dist_matrix['matrix'],difference_type))
+############################################################
+def euclidean_transform(pairwise_values,dtype=np.float64,block_size=None):
+    """
+    Function computes euclidean distances between the columns of a square pairwise array
+    (second order distances used as linkage input by plotPairwise_heatmap)
+    block_size computes block_size x block_size blocks so disk backed arrays are read piecewise
+    dtype=np.float32 halves memory of the N x N output
+    Example : euclidean_transform(pairwise_array.values)
+    Returns N x N array
+    """
+    cell_count=pairwise_values.shape[1]
+    if block_size is None:
+        columns=np.asarray(pairwise_values,dtype=np.float64).T
+        return(distance.squareform(distance.pdist(columns,'euclidean')).astype(dtype,copy=False))
+    euclid=np.zeros((cell_count,cell_count),dtype=dtype)
+    blocks=[(x,min(x+block_size,cell_count)) for x in range(0,cell_count,block_size)]
+    for num,(row_start,row_stop) in enumerate(blocks):
+        rows=np.asarray(pairwise_values[:,row_start:row_stop],dtype=np.float64).T
+        for col_start,col_stop in blocks[num:]:
+            cols=np.asarray(pairwise_values[:,col_start:col_stop],dtype=np.float64).T
+            euclid[row_start:row_stop,col_start:col_stop]=distance.cdist(rows,cols,'euclidean')
+            euclid[col_start:col_stop,row_start:row_stop]=euclid[row_start:row_stop,col_start:col_stop].T
+    return(euclid)
+############################################################
@@ -27,26 +27,37 @@ from plotly import tools
 import statsmodels.stats.multitest as multitest
 from rpy2 import robjects as ro
 from rpy2.robjects import r,pandas2ri 
+from rpy2.robjects import numpy2ri
+from rpy2.robjects.conversion import localconverter
 from rpy2.robjects.packages import importr
 
 from functools import reduce
+from .pairwise import *
+from .clustering import *
+from .rendering import *
+from .smoothing import *
 
 ########################################
-def plot_figure(fig,out_dir,file_name):
+def plot_figure(fig,out_dir,file_name,scale=10,queue=None,formats=('png','spec')):
     """
     Function for plotting figures in fixed dimensions and scale
     Example : plot_figure(methylation_figure,'/outdirectory/',methylation_boxplot.png)
-    Returns Png saved to /results/
+    scale multiplies the 800x800 output, lower it for raster heatmaps already aggregated to their pixel grid
+    With a queue (.figure_queue()) the figure is rendered in the background in formats, collect with .finish_figures()
+    Returns Png and figure spec (.save_figure(), reload with .load_figure()) saved to /results/
     """
     print("Running : Plotting "+file_name)
     t0 = time.time()
+    if queue is not None:
+        submit_figure(queue,fig,out_dir,file_name,formats,scale=scale)
+        return
     os.environ['TMPDIR']="/out_dir/tmp"
     plot_dim_x=800
     plot_dim_y=800
     #plotly.offline.iplot(fig,validate=False, filename='customizing-subplot-axes')
     
-    fig.write_image(out_dir+"/results/"+file_name+".png",width=plot_dim_x,height=plot_dim_y,scale=10)
-    pickle.dump(fig, open(out_dir+"/results/"+file_name+".pkl", "wb" ) )
+    fig.write_image(out_dir+"/results/"+file_name+".png",width=plot_dim_x,height=plot_dim_y,scale=scale)
+    save_figure(fig,out_dir+"/results/"+file_name)
     print(time.time()-t0)
 
 #########################################
@@ -62,8 +73,6 @@ def findFiles(list_of_files,out_dir,project_name):
     os.environ['TMPDIR']="/out_dir/tmp"
     #subprocess.run(["TMPDIR"+"="+out_dir+"/tmp"])
     pandas2ri.activate()
-    plotly.io.orca.ensure_server()
-    time.sleep(10)
 
     tmp=pd.DataFrame()
     tmp['bam']=list_of_files
@@ -288,75 +297,133 @@ def plotBoxplot(what_to_plot,stats,annotation,job_name,shared_axes=True):
     print(time.time()-t0)
     return(fig)
 #####################################################
-def plot_dendrogram_CNV(CNV,stats,annotations,annotations_category_colored,cut_tree):
+def domain_axes(fig,domains,titles=()):
+    """
+    Function adds one x/y axis pair per ([x0,x1],[y0,y1]) domain given in fractions of the figure
+    Unlike make_subplots grids the layout cost does not grow with the number of cells or windows
+    titles are written above the first panels
+    Example : domain_axes(go.Figure(),[([0,0.5],[0,1]),([0.5,1],[0,1])],["Left","Right"])
+    Returns list of panel dictionaries (axis names and trace references) in the order of domains
+    """
+    indices=[]
+    for num,(x_domain,y_domain) in enumerate(domains):
+        suffix="" if num==0 else str(num+1)
+        fig.layout["xaxis"+suffix]=dict(domain=[round(x,6) for x in x_domain],anchor="y"+suffix)
+        fig.layout["yaxis"+suffix]=dict(domain=[round(y,6) for y in y_domain],anchor="x"+suffix)
+        indices.append({'xaxis_name':"xaxis"+suffix,'yaxis_name':"yaxis"+suffix,'xref':"x"+suffix,'yref':"y"+suffix})
+    for (x_domain,y_domain),title in zip(domains,titles):
+        if title!="":
+            fig.add_annotation(text=title,x=round((x_domain[0]+x_domain[1])/2,6),y=round(y_domain[1],6),
+                               xref='paper',yref='paper',xanchor='center',yanchor='bottom',
+                               showarrow=False,font=dict(size=16))
+    return(indices)
+
+def add_panel_trace(fig,trace,panel):
+    """
+    Function adds trace to a panel of .domain_axes()
+    """
+    trace.update(xaxis=panel['xref'],yaxis=panel['yref'])
+    fig.add_trace(trace)
+
+def colorscale_lut(colorscale,levels=256):
+    """
+    Function samples a plotly colorscale (name or [[num,color],...]) into a lookup table
+    Example : colorscale_lut("RdBu")
+    Returns levels x 3 uint8 array of RGB colors
+    """
+    if isinstance(colorscale,str):
+        colorscale=plotly.colors.get_colorscale(colorscale)
+    nums=[float(x[0]) for x in colorscale]
+    rgb=np.array([plotly.colors.unlabel_rgb(plotly.colors.convert_colors_to_same_type(x[1],'rgb')[0][0]) for x in colorscale])
+    sample=np.linspace(0,1,levels)
+    return(np.stack([np.interp(sample,nums,rgb[:,x]) for x in range(0,3)],axis=1).round().astype(np.uint8))
+
+def aggregate_pixels(values,rows,cols,how='mean',row_order=None,col_order=None):
+    """
+    Function downsamples a 2D array (or disk backed matrix) to at most rows x cols pixels
+    how : 'mean' or 'max' of each pixel's values (NaN ignored), 'nearest' takes the value at each pixel's centre
+    row_order/col_order index the values before binning, gathered one pixel row at a time so no reordered copy of values is made
+    Example : aggregate_pixels(pairwise_values,1000,1000,'max',order,order[::-1])
+    Returns float64 array of pixel values
+    """
+    row_order=None if row_order is None else np.asarray(row_order)
+    col_order=None if col_order is None else np.asarray(col_order)
+    n_rows=values.shape[0] if row_order is None else len(row_order)
+    n_cols=values.shape[1] if col_order is None else len(col_order)
+    row_edges=np.linspace(0,n_rows,min(rows,n_rows)+1).astype(int)
+    col_edges=np.linspace(0,n_cols,min(cols,n_cols)+1).astype(int)
+    col_centres=(col_edges[:-1]+col_edges[1:])//2
+    pixels=np.empty((len(row_edges)-1,len(col_edges)-1))
+    for num,(start,end) in enumerate(zip(row_edges[:-1],row_edges[1:])):
+        if how=='nearest':
+            start=(start+end)//2;end=start+1
+        block=np.asarray(values[start:end] if row_order is None else values[row_order[start:end]],dtype=np.float64)
+        if col_order is not None:
+            block=block[:,col_order]
+        if how=='nearest':
+            pixels[num]=block[0,col_centres]
+        elif how=='max':
+            pixels[num]=np.fmax.reduceat(np.fmax.reduce(block,axis=0),col_edges[:-1])
+        else:
+            sums=np.add.reduceat(np.nansum(block,axis=0),col_edges[:-1])
+            counts=np.add.reduceat((~np.isnan(block)).sum(axis=0),col_edges[:-1])
+            pixels[num]=np.where(counts>0,sums/np.maximum(counts,1),np.nan)
+    return(pixels)
+
+def add_raster_panel(fig,values,panel,zmin,zmax,colorscale,raster_pixels=1400,how='mean',row_order=None,col_order=None):
+    """
+    Function draws a matrix into a panel of .domain_axes() as a pre-rasterized image layer
+    Replaces go.Heatmap for large matrices : the matrix is aggregated (.aggregate_pixels()) to the panel's share of raster_pixels,
+    so the figure payload depends on output resolution rather than on the matrix size. NaN pixels are transparent
+    Axes keep heatmap coordinates (cells at 0..n-1, first row at the bottom) so dendrograms stay aligned
+    """
+    n_rows=values.shape[0] if row_order is None else len(row_order)
+    n_cols=values.shape[1] if col_order is None else len(col_order)
+    x_domain=fig.layout[panel['xaxis_name']].domain
+    y_domain=fig.layout[panel['yaxis_name']].domain
+    pixels=aggregate_pixels(values,
+                            max(1,int(round((y_domain[1]-y_domain[0])*raster_pixels))),
+                            max(1,int(round((x_domain[1]-x_domain[0])*raster_pixels))),
+                            how,row_order,col_order)
+    scaled=(pixels-zmin)/(zmax-zmin) if zmax>zmin else np.zeros(pixels.shape)
+    rgba=np.concatenate([
+        colorscale_lut(colorscale)[np.clip(np.nan_to_num(scaled)*255,0,255).round().astype(int)],
+        np.where(np.isnan(pixels),0,255).astype(np.uint8)[:,:,None]
+    ],axis=2)
+    dx=n_cols/pixels.shape[1]
+    dy=n_rows/pixels.shape[0]
+    add_panel_trace(fig,go.Image(z=rgba,colormodel='rgba',zmax=[255,255,255,255],x0=-0.5+dx/2,dx=dx,y0=-0.5+dy/2,dy=dy,hoverinfo='skip'),panel)
+    fig.layout[panel['xaxis_name']].update(range=[-0.5,n_cols-0.5])
+    fig.layout[panel['yaxis_name']].update(range=[-0.5,n_rows-0.5])
+
+def plot_dendrogram_CNV(CNV,stats,annotations,annotations_category_colored,cut_tree,cache_dir=None,render='vector',raster_aggregate='mean',raster_pixels=1400):
     """
     Function clusters single cells by CNV in euclidean space
     Example : plot_dendrogram_CNV(.pullStatistics() CNV Output,.pullStatistics() statistics Output,['Methylation',"Example Annotation"],.ready_annotations() output, Number Of Tree clusters)
+    Linkage and cluster assignments are cached by CNV matrix (.cluster_linkage()), on disk in cache_dir if given
+    CNV is drawn as one genome wide heatmap with chromosome boundaries as lines and labels
+    render='raster' draws the CNV heatmap and annotation tracks as images aggregated by raster_aggregate ('mean' or 'max')
+    to raster_pixels across the figure (.add_raster_panel()), for projects with many cells
     Returns figure instance and single cell CNV groupings
     ### Developers note bit of a weird bug ongoing right where if CNV rows less than 10, legend position breaks
     """
     print("Running : Generating CNV dendrogram")
     t0 = time.time()
     ###Define spacing#####################################
-    ###End goal is nested array where inner array is row, outer is col
-    per_row_specs=[]
-    row_specs=None
-    total_specs=[]
-    anno_row_size=None
-    filler=None
-    annotation_size=None
-    
-    CNV_windows=CNV.groupby("Chromosome").count().sort_values("Start",ascending=False).Start.values.tolist()
-    ### establish rows first
-    row_specs=len(CNV.iloc[:,2:].columns.values.tolist())+2+len(annotations) ###length of CNV + annotations (default extends by one for CNV)
-    for x in CNV_windows:
-        per_row_specs.append({"rowspan":row_specs-(2+len(annotations)),"colspan":x})
-        per_row_specs.append(None) ###leave one col space between each chr and dendro
-        for y in range(1,x):
-            per_row_specs.append(None)
-
-    ### Add in spacing for annotations
-    annotation_size=int(CNV_windows[1]/3)
-    for x in range(0,len(annotations)+1):
-        for x in range(0,annotation_size):
-            per_row_specs.insert(0,None)
-        per_row_specs.insert(0,{"rowspan":row_specs-(2+len(annotations)),"colspan":annotation_size})
-
-    ### Add in spacing for dendrogram
-    for x in range(0,annotation_size*3):
-         per_row_specs.insert(0,None)
-
-    per_row_specs.insert(0,{"rowspan":row_specs-(2+len(annotations)),"colspan":annotation_size*3})
-
-    ###fill in gaps in body cols
-    total_specs.append(per_row_specs)
-    for x in range(1,row_specs-(2+len(annotations))):
-         total_specs.append([None]*len(per_row_specs))
-    
-    
-    ### Add spaces for annotations legends
-    anno_row_size=int(len(total_specs)/10)
-    filler=int(len(per_row_specs)/4-1)
-    
-    for y in range(0,anno_row_size):
-        total_specs.append([None]*len(per_row_specs))
-
-    for x in range(0,len(annotations)+1):
-        total_specs.append(
-            [None]*filler+[{"rowspan":anno_row_size,"colspan":len(per_row_specs)-filler*2}]+[None]*(len(per_row_specs)-filler-1)
-        )
-        for y in range(0,anno_row_size*2):
-            total_specs.append([None]*len(per_row_specs))
-        
-    total_specs.append(
-        [None]*filler+[{"rowspan":anno_row_size,"colspan":len(per_row_specs)-filler*2}]+[None]*(len(per_row_specs)-filler-1)
-    )
-    for y in range(0,anno_row_size):
-            total_specs.append([None]*len(per_row_specs))
+    ###Panels are fixed fractions of the figure, independent of cell and window counts
+    ###Windows are laid out as one genome wide matrix, chromosomes in order of appearance
+    chromosomes=CNV.Chromosome.unique().tolist()
+    CNV=CNV.iloc[np.argsort(CNV.Chromosome.map(dict(zip(chromosomes,range(0,len(chromosomes))))).values,kind='stable')]
+    CNV_windows=CNV.groupby("Chromosome",sort=False).size().loc[chromosomes].values
+    chr_starts=np.concatenate([[0],np.cumsum(CNV_windows)[:-1]])
+    dendrogram_width=0.07
+    annotation_width=0.022
+    body_height=1/(1+(3*len(annotations)+6)/10)
+    legend_height=body_height/10
 
     ###Define dendogram#####################################    
-    Z = scipy.cluster.hierarchy.linkage(1-CNV.iloc[:,2:].corr(), 'ward')
-    dn = scipy.cluster.hierarchy.dendrogram(Z, labels = CNV.iloc[:,2:].corr().columns,no_plot=True)
+    clustering=cluster_linkage(CNV.iloc[:,2:].values,CNV.iloc[:,2:].columns.tolist(),'ward',correlation_distance,cache_dir,[cut_tree])
+    dn = clustering['dendrogram']
     icoord = dn['icoord']
     dcoord = dn['dcoord']
     ordered_labels = dn['ivl']
@@ -380,9 +447,7 @@ def plot_dendrogram_CNV(CNV,stats,annotations,annotations_category_colored,cut_t
 
     zero_vals.sort()
     #########Define dendrogram groups
-    cutree = hierarchy.cut_tree(Z, n_clusters=cut_tree)
-    cnv_clusters=pd.DataFrame(index=CNV.iloc[:,2:].columns.tolist())
-    cnv_clusters['cnv_clusters']=[chr(x[0]+65) for x in cutree]
+    cnv_clusters=cluster_assignments(clustering,cut_tree,'cnv_clusters',cache_dir)
     
     #########Alter annotation dictionary for CNV scale and CNV groups
     annotations_category_colored['cnv_clusters']={}
@@ -401,29 +466,22 @@ def plot_dendrogram_CNV(CNV,stats,annotations,annotations_category_colored,cut_t
 
             
     ###initialize plotting frame###########################################
-    fig = plotly.subplots.make_subplots(rows=len(total_specs),
-                              cols=len(total_specs[0]),
-                              subplot_titles=[""]+annotations+["CNV_cluster"]+CNV.Chromosome.unique().tolist(),
-                              specs=total_specs,
-                              print_grid=False
-                             )
+    genome_left=dendrogram_width+annotation_width*(len(annotations)+1)
+    domains=[([0,dendrogram_width],[1-body_height,1])]
+    domains+=[([dendrogram_width+annotation_width*x,dendrogram_width+annotation_width*(x+1)],[1-body_height,1]) for x in range(0,len(annotations)+1)]
+    domains+=[([genome_left,1],[1-body_height,1])]
+    ###One legend row per annotation, cnv_clusters and CNV
+    domains+=[([0.25,0.75],[1-body_height-legend_height*(2+3*x),1-body_height-legend_height*(1+3*x)]) for x in range(0,len(annotations)+2)]
+    fig = go.Figure()
     
     ###Return plotting frame coordinates and axis names###########################################
     
     icount=0
-    indices=[]
-    m=re.findall(r"\(.*?y[0-9]*",fig._grid_str.replace("(empty)",""))
-    for x in m:
-        tmp={}
-        tmp['xaxis_num']=int(x.split(" ")[0].split(",")[0].replace("(",""))
-        tmp['yaxis_num']=int(x.split(" ")[0].split(",")[-1].replace(")",""))
-        tmp['xaxis_name']="xaxis"+x.split(" ")[1].split(",")[0][1:]
-        tmp['yaxis_name']="yaxis"+x.split(" ")[1].split(",")[1][1:]
-        indices.append(tmp)
+    indices=domain_axes(fig,domains,[""]+annotations+["CNV_cluster"])
 
     ###plot nodes to vertical dendrogram
     for label,dcoor,icoor in zip(ordered_labels,dcoord,icoord):
-        fig.append_trace(
+        add_panel_trace(fig,
             go.Scatter(
                 x=dcoor,
                 y=icoor,
@@ -431,7 +489,7 @@ def plot_dendrogram_CNV(CNV,stats,annotations,annotations_category_colored,cut_t
                 text=ordered_labels,
                 marker=dict(color='black'),
                 showlegend=False
-            ),indices[icount]['xaxis_num'],indices[icount]['yaxis_num'])
+            ),indices[icount])
     
     fig.layout[indices[icount]['xaxis_name']].update(
         autorange='reversed',
@@ -450,16 +508,21 @@ def plot_dendrogram_CNV(CNV,stats,annotations,annotations_category_colored,cut_t
     for xanno in annotations+['cnv_clusters']:
         if annotations_category_colored[xanno]["type"]=="numeric":
             tmp=stats.loc[ordered_labels,xanno]
-            fig.append_trace(
-            go.Heatmap(
-                z=[[x]for x in tmp.values.tolist()],
-                y=tmp.index.values.tolist(),
-                zmin=annotations_category_colored[xanno]['cmin'],
-                zmax=annotations_category_colored[xanno]['cmax'],
-                colorscale=annotations_category_colored[xanno]['color'],
-                showscale=False
-            ),indices[icount]['xaxis_num'],indices[icount]['yaxis_num']
-            )
+            if render=='raster':
+                add_raster_panel(fig,tmp.values.astype(float)[:,None],indices[icount],
+                                 annotations_category_colored[xanno]['cmin'],annotations_category_colored[xanno]['cmax'],
+                                 annotations_category_colored[xanno]['color'],raster_pixels,raster_aggregate)
+            else:
+                add_panel_trace(fig,
+                go.Heatmap(
+                    z=[[x]for x in tmp.values.tolist()],
+                    y=tmp.index.values.tolist(),
+                    zmin=annotations_category_colored[xanno]['cmin'],
+                    zmax=annotations_category_colored[xanno]['cmax'],
+                    colorscale=annotations_category_colored[xanno]['color'],
+                    showscale=False
+                ),indices[icount]
+                )
         else:
             if xanno!='cnv_clusters':
                 tmp=stats.loc[ordered_labels,xanno]
@@ -472,36 +535,49 @@ def plot_dendrogram_CNV(CNV,stats,annotations,annotations_category_colored,cut_t
             colorscale=[[annotations_category_colored[xanno][z]['num'],annotations_category_colored[xanno][z]['color']] for z in [*annotations_category_colored[xanno].keys()][1:]]
             if len(colorscale)==1:
                 colorscale.insert(0,[0,colorscale[0][1]])
-            fig.append_trace(
-            go.Heatmap(
-                z=[[x]for x in tmp.values.tolist()],
-                y=tmp.index.values.tolist(),
-                colorscale=colorscale,
-                showscale=False
-            ),indices[icount]['xaxis_num'],indices[icount]['yaxis_num']
-            )
+            if render=='raster':
+                add_raster_panel(fig,tmp.values.astype(float)[:,None],indices[icount],0,1,colorscale,raster_pixels,'nearest')
+            else:
+                add_panel_trace(fig,
+                go.Heatmap(
+                    z=[[x]for x in tmp.values.tolist()],
+                    y=tmp.index.values.tolist(),
+                    colorscale=colorscale,
+                    showscale=False
+                ),indices[icount]
+                )
             
         fig['layout'][indices[icount]['yaxis_name']].update(showticklabels=False,ticks="")
         fig['layout'][indices[icount]['xaxis_name']].update(showticklabels=False,ticks="")
         icount+=1; 
     
-    ####Plot CNV heatmaps
+    ####Plot CNV heatmap : one cell x window matrix across the genome
     cnv_max=max(CNV.iloc[:,2:].max())
     cnv_min=0
-    for x in CNV.Chromosome.unique().tolist():
-        fig.append_trace(
+    genome=CNV.loc[:,ordered_labels].values.T
+    if render=='raster':
+        add_raster_panel(fig,genome,indices[icount],cnv_min,cnv_max,"RdBu",raster_pixels,raster_aggregate)
+    else:
+        add_panel_trace(fig,
         go.Heatmap(
-            z=CNV.query("Chromosome==@x").loc[:,ordered_labels].T.values.tolist(),
-            y=CNV.loc[:,ordered_labels].columns.values.tolist(),
+            z=genome,
+            y=ordered_labels,
             zmin=cnv_min,
             zmax=cnv_max,
             showscale=False,
             colorscale="RdBu"
-        ),indices[icount]['xaxis_num'],indices[icount]['yaxis_num']
+        ),indices[icount]
         )
-        fig['layout'][indices[icount]['yaxis_name']].update(showticklabels=False,ticks="")
-        fig['layout'][indices[icount]['xaxis_name']].update(showticklabels=False,ticks="")
-        icount+=1;
+    fig['layout'][indices[icount]['yaxis_name']].update(showticklabels=False,ticks="")
+    fig['layout'][indices[icount]['xaxis_name']].update(showticklabels=False,ticks="",range=[-0.5,len(genome[0])-0.5])
+    ###chromosome boundaries and labels
+    for x in chr_starts[1:]:
+        fig.add_shape(type='line',x0=x-0.5,x1=x-0.5,y0=1-body_height,y1=1,
+                      xref=indices[icount]['xref'],yref='paper',line=dict(color='black',width=1))
+    for x,start,windows in zip(chromosomes,chr_starts,CNV_windows):
+        fig.add_annotation(text=x,x=start+windows/2-0.5,y=1,xref=indices[icount]['xref'],yref='paper',
+                           xanchor='center',yanchor='bottom',showarrow=False,font=dict(size=16))
+    icount+=1;
     
     
     ### hide axis across dendrograms except annotations and dendrogram
@@ -522,7 +598,7 @@ def plot_dendrogram_CNV(CNV,stats,annotations,annotations_category_colored,cut_t
                     ))
                 ]+[round(annotations_category_colored[xanno]['cmax'],2)]
 
-            fig.append_trace(
+            add_panel_trace(fig,
             go.Scattergl(
                 x=tmp,
                 y=[xanno]*len(tmp),
@@ -538,7 +614,7 @@ def plot_dendrogram_CNV(CNV,stats,annotations,annotations_category_colored,cut_t
                 text=[tmp[0]]+["" for x in range(0,len(tmp)-2)]+[tmp[-1]],
                 textfont=dict(size=10,color="black"),
                 textposition=['middle left']*(len(tmp)-1)+['middle right']
-            ),indices[icount]['xaxis_num'],indices[icount]['yaxis_num']
+            ),indices[icount]
             )
             fig['layout'][indices[icount]['yaxis_name']].update(
                 showticklabels=True,
@@ -558,7 +634,7 @@ def plot_dendrogram_CNV(CNV,stats,annotations,annotations_category_colored,cut_t
             ) 
         else:
             tmp=[annotations_category_colored[xanno][x]['num'] for x in list(annotations_category_colored[xanno].keys())[1:]]
-            fig.append_trace(
+            add_panel_trace(fig,
             go.Scattergl(
                 x=tmp,
                 y=[xanno]*len(list(annotations_category_colored[xanno].keys())[1:]),
@@ -569,7 +645,7 @@ def plot_dendrogram_CNV(CNV,stats,annotations,annotations_category_colored,cut_t
                 mode='markers+text',
                 textposition='middle left',
                 textfont=dict(color='black',size=15)
-            ),indices[icount]['xaxis_num'],indices[icount]['yaxis_num']
+            ),indices[icount]
             )
             fig['layout'][indices[icount]['yaxis_name']].update(
                 showticklabels=True,
@@ -585,7 +661,7 @@ def plot_dendrogram_CNV(CNV,stats,annotations,annotations_category_colored,cut_t
             )
         icount+=1;
         
-    fig.append_trace(
+    add_panel_trace(fig,
         go.Scattergl(
             x=[50+x for x in range(int(cnv_min),int(cnv_max)+1,1)],
             text=[int(cnv_min)]+["" for x in range(int(cnv_min)+1,int(cnv_max),1)]+[int(cnv_max)],
@@ -599,7 +675,7 @@ def plot_dendrogram_CNV(CNV,stats,annotations,annotations_category_colored,cut_t
             color="black"
             ),
             showlegend=False
-        ),indices[icount]['xaxis_num'],indices[icount]['yaxis_num']
+        ),indices[icount]
         )
     fig['layout'][indices[icount]['xaxis_name']]\
     .update(showticklabels=False,
@@ -623,33 +699,113 @@ def plot_dendrogram_CNV(CNV,stats,annotations,annotations_category_colored,cut_t
     return(fig,cnv_clusters)
         
 ############################################################
-def pool_pairwise_combination(cpgs,core_count,chr_list,difference_type,directory_path,libid):
+def pool_pairwise_combination(cpgs,core_count,chr_list,difference_type,directory_path,libid,mode='pairs',reference_cpgs=None,tile_size=64,output='frame',matrix_layout='square',sketch_size=50000,candidates=15,benchmark_cells=50,existing=None):
     """
     Wrapper function for determining pairwise distance across single cell methylations samples
     Example : pool_pairwise_combination(["SampleA","SampleB"],4,["chr1","chr2","man_dist_scaled","/outdirectory/","JOB_NAME"])
-    Saves intermediate files in results
-    Returns Datafarme of pairwise distances
+    Modes : 'pairs' re-reads both CpG files per pair, 'matrix' parses each CpG file once into a sparse cell x CpG matrix,
+    'bitset' packs each CpG file once into covered/methylated bitsets over reference_cpgs (/ref/<ref>.CG.bed.gz) or the cells' CpGs,
+    'tiled' computes the bitset distances as tile_size x tile_size blocks across core_count workers sharing the bitsets
+    Saves intermediate files in results keyed by cell set, distance type, chr_list and reference CpGs; reruns resume from them
+    'sketch' estimates distances from hashed CpG samples of ~sketch_size CpGs per cell, recomputes the candidates
+    nearest estimates per cell exactly and saves the estimation error on benchmark_cells cells to results
+    existing (an earlier result) only computes pairs of cells new to it, see .update_pairwise_combination()
+    'bitset' and 'tiled' save the cell bitsets in results so such updates only parse the new cells' CpG files
+    output='memmap' fills a disk backed float32 matrix (matrix_layout 'square' or 'condensed') in results, tile by tile
+    ('pairs' and 'bitset' run as 'tiled'), by row blocks for 'matrix' and from the finished matrix for 'sketch'
+    Returns Datafarme of pairwise distances, or distance matrix dictionary (.open_distance_matrix()) for output='memmap'
     """
     print("Running : Pooling Pairwisie combinations")
     t0 = time.time()
+    if existing is not None:
+        return update_pairwise_combination(existing,cpgs,core_count,chr_list,difference_type,directory_path,libid,
+                                           reference_cpgs,tile_size,output,matrix_layout)
+    memmap_path=directory_path+"/results/"+libid+"_"+difference_type+"_"+matrix_layout+".f32"
+    if mode=='matrix':
+        cpg_matrix=load_cpg_matrix(cpgs,chr_list,core_count)
+        if output=='memmap':
+            distances=pairwise_distances_sparse(cpg_matrix,difference_type,
+                                                output=create_distance_memmap(memmap_path,cpgs,difference_type,matrix_layout))
+            del cpg_matrix
+            print(time.time()-t0)
+            return distances
+        pairwise_df=pairwise_frame(cpgs,pairwise_distances_sparse(cpg_matrix,difference_type),difference_type)
+        del cpg_matrix
+        print(time.time()-t0)
+        return pairwise_df
+    if mode=='sketch':
+        cpg_matrix=load_cpg_matrix(cpgs,chr_list,core_count)
+        distances,sketch=pairwise_distances_sketch(cpg_matrix,difference_type,sketch_size,candidates)
+        benchmark=sketch_benchmark(cpg_matrix,sketch,difference_type,benchmark_cells,candidates)
+        print("Sketch estimation error :")
+        print(benchmark.to_string(index=False))
+        benchmark.to_csv(directory_path+"/results/"+libid+"_sketch_benchmark.tsv",sep='\t',index=False)
+        if output=='memmap':
+            ###Refinement mirrors values across rows, so the sketch matrix is completed in memory before writing
+            dist_matrix=create_distance_memmap(memmap_path,cpgs,difference_type,matrix_layout)
+            for x in range(0,len(cpgs),tile_size):
+                rows=(x,min(x+tile_size,len(cpgs)))
+                write_distance_block(dist_matrix,(rows,(0,len(cpgs))),distances[rows[0]:rows[1]])
+            dist_matrix['matrix'].flush()
+            del cpg_matrix,sketch,distances
+            print(time.time()-t0)
+            return dist_matrix
+        pairwise_df=pairwise_frame(cpgs,distances,difference_type)
+        del cpg_matrix,sketch
+        print(time.time()-t0)
+        return pairwise_df
+    if output=='memmap':
+        mode='tiled'
+    if mode in ['bitset','tiled']:
+        cpg_index=None if reference_cpgs is None else load_reference_cpgs(reference_cpgs,chr_list)
+        bitset_file=directory_path+"/results/"+libid+"_bitsets.npz"
+        checkpoint=checkpoint_key(cpgs,difference_type,chr_list,tile_size,cpg_index)
+        checkpoint_dir=directory_path+"/results/"+libid+"_pairwise_"+checkpoint[1][:16]
+        cell_bitsets=None
+        completed=completed_tiles(checkpoint_dir,checkpoint[1]) if mode=='tiled' else set()
+        if len(completed)>0:
+            ###Resumed runs need no bitsets once every tile is done, otherwise reuse those of the interrupted run
+            if all(tile_name(x) in completed for x in tile_pairs(len(cpgs),tile_size)):
+                cell_bitsets={'samples':list(cpgs)}
+            else:
+                cell_bitsets=load_saved_bitsets(bitset_file,cpgs,chr_list,cpg_index)
+        if cell_bitsets is None:
+            cell_bitsets=load_cpg_bitsets(cpgs,chr_list,core_count,cpg_index)
+            ###Kept so runs adding cells (existing=) only parse the new cells
+            save_cpg_bitsets(cell_bitsets,bitset_file,chr_list)
+        if mode=='tiled':
+            dist_matrix=None
+            if output=='memmap':
+                dist_matrix=create_distance_memmap(memmap_path,cpgs,difference_type,matrix_layout)
+            distances=pool_pairwise_tiles(cell_bitsets,core_count,difference_type,tile_size,
+                                          checkpoint_dir,checkpoint,dist_matrix)
+        else:
+            distances=pairwise_distances_bitset(cell_bitsets,difference_type)
+        if output=='memmap':
+            del cell_bitsets
+            print(time.time()-t0)
+            return distances
+        pairwise_df=pairwise_frame(cpgs,distances,difference_type)
+        del cell_bitsets
+        print(time.time()-t0)
+        return pairwise_df
     combinations=list(itertools.combinations_with_replacement(cpgs,2))
     pool = mp.Pool(core_count,maxtasksperchild=1)
     chr_comb=[list(x)+[chr_list,difference_type] for x in combinations]
     chunks = [chr_comb[x:x+300] for x in range(0, len(chr_comb), 300)]
+    ###Chunk files are keyed by configuration so stale pickles from other runs are never picked up
+    chunk_file=directory_path+"/results/"+libid+"_pr_"+checkpoint_key(cpgs,difference_type,chr_list)[1][:16]+"_"
     chunks_to_run=[]
     for x in range(0,len(chunks)):
-        if not(os.path.isfile(directory_path+"/results/"+libid+"_pr"+str(x)+".pkl")):
-            chunks_to_run.append(chunks[0])
+        if not(os.path.isfile(chunk_file+str(x)+".pkl")):
+            chunks_to_run.append(x)
     
     if len(chunks_to_run)>0:
-        for x in range(0,len(chunks_to_run)):
-            pd.DataFrame(pool.map(pairwise_combination,chunks[x])).to_pickle(directory_path+"/results/"+libid+"_pr"+str(x)+".pkl") 
+        for x in chunks_to_run:
+            chunk_df=pd.DataFrame(pool.map(pairwise_combination,chunks[x]))
+            atomic_write(chunk_file+str(x)+".pkl",lambda f : pickle.dump(chunk_df,f))
     
-    results = pd.concat(pd.
-                 read_pickle(sample) for sample in glob.iglob(
-                     directory_path+"/results/"+libid+"_pr"+"*.pkl",
-                     recursive=False
-                 ))
+    results = pd.concat(pd.read_pickle(chunk_file+str(x)+".pkl") for x in range(0,len(chunks)))
     pool.close()
     del pool
     pairwise_other_half = results[[1,0,2]]
@@ -714,81 +870,37 @@ def pairwise_combination(samples):
     del merged
     return (samples[0],samples[1],difference)
 ############################################################
-def plotPairwise_heatmap(pairwise_array,stats,annotations,annotations_category_colored,cut_tree,difference_type):
+def plotPairwise_heatmap(pairwise_array,stats,annotations,annotations_category_colored,cut_tree,difference_type,euclid_dtype=np.float64,block_size=None,cache_dir=None,render='vector',raster_aggregate='mean',raster_pixels=1400):
     """
     Wrapper ploting heatmap and associated annotations for pairwise clustering of single cell samples
     Example : plotPairwise_heatmap(.pool_pairwise_combination()  Output,.pullStatistics() statistics Output,['Methylation',"Example Annotation"],.ready_annotations() output, Number Of Tree clusters,"man_dist_scaled")
+    pairwise_array may be a pivoted DataFrame or a distance matrix dictionary (.open_distance_matrix())
+    euclid_dtype and block_size set precision and blocking of the euclidean transform (.euclidean_transform())
+    Linkage and cluster assignments are cached by pairwise matrix (.cluster_linkage()), on disk in cache_dir if given
+    render='raster' draws the N x N matrix and annotation tracks as images aggregated by raster_aggregate ('mean' or 'max')
+    to raster_pixels across the figure (.add_raster_panel()), so figure size and render time no longer grow with N squared
     Returns figure instance and Single cell methylation groupings
     """
     print("Running : Generating Heatmap")
     t0 = time.time()
-    ###Set dimensions given pw_array
-    xdim = 12 if pairwise_array.shape[1] < 12 else pairwise_array.shape[1]
-    ydim = 12 if pairwise_array.shape[0] < 12 else pairwise_array.shape[0]
-    ### Convert pairwise distances to euclidean distances
-    euclid_pairwise_array=pd.DataFrame()
-
-    for row in pairwise_array.index.values.tolist():
-        for col in pairwise_array.columns.values.tolist():
-            row_array=pairwise_array.loc[:,row].values.tolist()
-            col_array=pairwise_array.loc[:,col].values.tolist()
-            dist=distance.euclidean(row_array,col_array)
-            euclid_pairwise_array.loc[row,col]=distance.euclidean(pairwise_array.loc[:,row].values.tolist(), pairwise_array.loc[:,col].values.tolist())
-
-    ### Assign Spacing
-    specs=[]
-    ###Space for horizontal dendrogram
-    specs.append(
-        [None]*(round(ydim/6)+len(annotations)+1)+\
-        [{'rowspan': round(ydim/6),'colspan': xdim}]+\
-        [None]*(ydim-1)
-    )
-    ### Filler space for horizontal dendogram
-    for x in range(0,round(ydim/6)-1):
-        specs.append([None]*len(specs[0]))
-    ### Add space per horizontal annotation
-    for x in range(0,len(annotations)+1):
-        specs.append(
-            [None]*(round(ydim/6)+len(annotations)+1)+\
-            [{'rowspan': round(ydim/12),'colspan': xdim}]+\
-            [None]*(ydim-1)
-    )
-    ### Make a temporary array cause I'm too much of an idiot how to figure out how to do it in one shot
-    tmp_array=[]
-    ### Space for vertical dendrogram
-    tmp_array.append({'rowspan': ydim,'colspan': round(xdim/6)})
-    ### Filler Vertical dendrogram spacing
-    for x in range(0,round(ydim/6)-1):
-        tmp_array.append(None)
-    ### Add space per vertical annotation
-    for x in range(0,len(annotations)+1):
-        tmp_array.append({'rowspan': ydim,'colspan': round(xdim/12)})
-    ### Add heatmap
-    tmp_array.append({'rowspan': ydim,'colspan': xdim})
-    ### Filler heatmap spacing : columns
-    for x in range(0,xdim-1):
-        tmp_array.append(None)
-    ### Add to specs
-    specs.append(tmp_array);del tmp_array
-    ### Filler spacing : rows
-    for x in range(0,xdim+1):
-        specs.append([None]*len(specs[0]))
-    ### Add space per annotation legend
-    for x in range(0,len(annotations)+2):
-        specs.append([None]*(len(specs[0])-ydim)+[{'rowspan': 2,'colspan': ydim}]+[None]*(ydim-1))
-        specs.append([None]*len(specs[0]));specs.append([None]*len(specs[0]));specs.append([None]*len(specs[0]))
-        
-    specs.pop();specs.pop()
+    labels,pairwise_values=distance_matrix_values(pairwise_array)
+    positions=dict(zip(labels,range(0,len(labels))))
+    ### Assign Spacing : fixed fractions of the figure, independent of the number of cells
+    strips=len(annotations)+1
+    dendrogram_size=0.12
+    annotation_size=0.02
+    legend_size=0.035
+    heatmap_left=dendrogram_size+annotation_size*strips
+    heatmap_top=1-dendrogram_size-annotation_size*strips
+    heatmap_bottom=legend_size*(strips+1)+0.02
 
 
-    ### Hierarchical clustering of euclidean array
-    Z = hierarchy.linkage(euclid_pairwise_array, 'ward')
+    ### Hierarchical clustering of pairwise distances converted to euclidean distances
+    clustering=cluster_linkage(pairwise_values,labels,'ward',euclidean_transform,cache_dir,[cut_tree],dtype=euclid_dtype,block_size=block_size)
     ### Make into dendrograms
-    dn = hierarchy.dendrogram(Z, labels = euclid_pairwise_array.columns,no_plot=True)
+    dn = clustering['dendrogram']
     ### Define clusters
-    cutree = hierarchy.cut_tree(Z, n_clusters=cut_tree)
-    pdclust_clusters=pd.DataFrame(index=euclid_pairwise_array.columns)
-    pdclust_clusters['pdclust_clusters']=[chr(x[0]+65) for x in cutree]
+    pdclust_clusters=cluster_assignments(clustering,cut_tree,'pdclust_clusters',cache_dir)
     ### Set coordinates and orderlabels
     icoord = dn['icoord']
     dcoord = dn['dcoord']
@@ -832,28 +944,19 @@ def plotPairwise_heatmap(pairwise_array,stats,annotations,annotations_category_c
     zero_vals.sort()
 
     ###initialize plotting frame
-    fig = plotly.subplots.make_subplots(rows=len(specs),
-                                  cols=len(specs[0]),
-                                  print_grid=False,
-                              vertical_spacing=0,
-                              horizontal_spacing=0,
-                              specs=specs,
-                                 )
-    
+    domains=[([heatmap_left,1],[1-dendrogram_size,1])]
+    domains+=[([heatmap_left,1],[1-dendrogram_size-annotation_size*(x+1),1-dendrogram_size-annotation_size*x]) for x in range(0,strips)]
+    domains+=[([0,dendrogram_size],[heatmap_bottom,heatmap_top])]
+    domains+=[([dendrogram_size+annotation_size*x,dendrogram_size+annotation_size*(x+1)],[heatmap_bottom,heatmap_top]) for x in range(0,strips)]
+    domains+=[([heatmap_left,1],[heatmap_bottom,heatmap_top])]
+    domains+=[([heatmap_left,1],[legend_size*(strips-x),legend_size*(strips-x+0.6)]) for x in range(0,strips+1)]
+    fig = go.Figure()
     icount=0
-    indices=[]
-    m=re.findall(r"\(.*?y[0-9]*",fig._grid_str.replace("(empty)",""))
-    for x in m:
-        tmp={}
-        tmp['xaxis_num']=int(x.split(" ")[0].split(",")[0].replace("(",""))
-        tmp['yaxis_num']=int(x.split(" ")[0].split(",")[-1].replace(")",""))
-        tmp['xaxis_name']="xaxis"+x.split(" ")[1].split(",")[0][1:]
-        tmp['yaxis_name']="yaxis"+x.split(" ")[1].split(",")[1][1:]
-        indices.append(tmp)
+    indices=domain_axes(fig,domains)
 
     ###plot nodes to horizontal dendrogram
     for label,dcoor,icoor in zip(ordered_labels,dcoord,icoord):
-            fig.append_trace(
+            add_panel_trace(fig,
                 go.Scatter(
                     x=icoor,
                     y=dcoor,
@@ -862,7 +965,7 @@ def plotPairwise_heatmap(pairwise_array,stats,annotations,annotations_category_c
                     marker=dict(color='black'),
                     showlegend=False,
                     hoverinfo='none'
-                ),indices[icount]['xaxis_num'],indices[icount]['yaxis_num']
+                ),indices[icount]
             )
 
     ###set horizontal dendrogram labels
@@ -879,15 +982,20 @@ def plotPairwise_heatmap(pairwise_array,stats,annotations,annotations_category_c
     for xanno in annotations+["pdclust_clusters"]:
         if annotations_category_colored[xanno]["type"]=="numeric":
             tmp=stats.loc[ordered_labels,xanno]
-            fig.append_trace(
-            go.Heatmap(
-                z=[[x for x in tmp.values.tolist()]],
-                x=tmp.index.values.tolist(),
-                zmin=annotations_category_colored[xanno]['cmin'],
-                zmax=annotations_category_colored[xanno]['cmax'],
-                colorscale=annotations_category_colored[xanno]['color'],showscale=False
-            ),indices[icount]['xaxis_num'],indices[icount]['yaxis_num']
-            )
+            if render=='raster':
+                add_raster_panel(fig,tmp.values.astype(float)[None,:],indices[icount],
+                                 annotations_category_colored[xanno]['cmin'],annotations_category_colored[xanno]['cmax'],
+                                 annotations_category_colored[xanno]['color'],raster_pixels,raster_aggregate)
+            else:
+                add_panel_trace(fig,
+                go.Heatmap(
+                    z=[[x for x in tmp.values.tolist()]],
+                    x=tmp.index.values.tolist(),
+                    zmin=annotations_category_colored[xanno]['cmin'],
+                    zmax=annotations_category_colored[xanno]['cmax'],
+                    colorscale=annotations_category_colored[xanno]['color'],showscale=False
+                ),indices[icount]
+                )
         else:
             if xanno=='pdclust_clusters':
                 tmp=pdclust_clusters.loc[ordered_labels,"pdclust_clusters"]
@@ -900,21 +1008,24 @@ def plotPairwise_heatmap(pairwise_array,stats,annotations,annotations_category_c
             if len(colorscale)==1:
                 colorscale.insert(0,[0,colorscale[0][1]])
 
-            fig.append_trace(
-            go.Heatmap(
-                z=[[x for x in tmp.values.tolist()]],
-                x=tmp.index.values.tolist(),
-                colorscale=colorscale,
-                showscale=False
-            ),indices[icount]['xaxis_num'],indices[icount]['yaxis_num']
-            )   
+            if render=='raster':
+                add_raster_panel(fig,tmp.values.astype(float)[None,:],indices[icount],0,1,colorscale,raster_pixels,'nearest')
+            else:
+                add_panel_trace(fig,
+                go.Heatmap(
+                    z=[[x for x in tmp.values.tolist()]],
+                    x=tmp.index.values.tolist(),
+                    colorscale=colorscale,
+                    showscale=False
+                ),indices[icount]
+                )
         fig.layout[indices[icount]['yaxis_name']].update(showticklabels=False,ticks="")
         fig.layout[indices[icount]['xaxis_name']].update(showticklabels=False,ticks="")
         icount+=1 
 
     ###plot nodes to vertical dendrogram
     for label,dcoor,icoor in zip(ordered_labels,dcoord,icoord):
-        fig.append_trace(
+        add_panel_trace(fig,
             go.Scatter(
                 x=dcoor,
                 y=icoor,
@@ -922,7 +1033,7 @@ def plotPairwise_heatmap(pairwise_array,stats,annotations,annotations_category_c
                 #text=ordered_labels,
                 marker=dict(color='black'),
                 showlegend=False
-            ),indices[icount]['xaxis_num'],indices[icount]['yaxis_num']
+            ),indices[icount]
         )
     ### Set veritcal dendrogram labels
     fig.layout[indices[icount]['xaxis_name']].update(autorange='reversed',gridcolor='lightgrey')
@@ -937,15 +1048,20 @@ def plotPairwise_heatmap(pairwise_array,stats,annotations,annotations_category_c
     for xanno in annotations+["pdclust_clusters"]:
         if annotations_category_colored[xanno]["type"]=="numeric":
             tmp=stats.loc[ordered_labels[::-1],xanno]
-            fig.append_trace(
-            go.Heatmap(
-                z=[[x] for x in tmp.values.tolist()],
-                y=tmp.index.values.tolist(),
-                zmin=annotations_category_colored[xanno]['cmin'],
-                zmax=annotations_category_colored[xanno]['cmax'],
-                colorscale=annotations_category_colored[xanno]['color'],showscale=False
-            ),indices[icount]['xaxis_num'],indices[icount]['yaxis_num']
-            )
+            if render=='raster':
+                add_raster_panel(fig,tmp.values.astype(float)[:,None],indices[icount],
+                                 annotations_category_colored[xanno]['cmin'],annotations_category_colored[xanno]['cmax'],
+                                 annotations_category_colored[xanno]['color'],raster_pixels,raster_aggregate)
+            else:
+                add_panel_trace(fig,
+                go.Heatmap(
+                    z=[[x] for x in tmp.values.tolist()],
+                    y=tmp.index.values.tolist(),
+                    zmin=annotations_category_colored[xanno]['cmin'],
+                    zmax=annotations_category_colored[xanno]['cmax'],
+                    colorscale=annotations_category_colored[xanno]['color'],showscale=False
+                ),indices[icount]
+                )
         else:
             if xanno=='pdclust_clusters':
                 tmp=pdclust_clusters.loc[ordered_labels[::-1],"pdclust_clusters"]
@@ -957,29 +1073,37 @@ def plotPairwise_heatmap(pairwise_array,stats,annotations,annotations_category_c
             colorscale=[[annotations_category_colored[xanno][z]['num'],annotations_category_colored[xanno][z]['color']] for z in [*annotations_category_colored[xanno].keys()][1:]]
             if len(colorscale)==1:
                 colorscale.insert(0,[0,colorscale[0][1]])
-            fig.append_trace(
-            go.Heatmap(
-                z=[[x] for x in tmp.values.tolist()],
-                y=tmp.index.values.tolist(),
-                colorscale=colorscale,
-                showscale=False
-            ),indices[icount]['xaxis_num'],indices[icount]['yaxis_num']
-            )   
+            if render=='raster':
+                add_raster_panel(fig,tmp.values.astype(float)[:,None],indices[icount],0,1,colorscale,raster_pixels,'nearest')
+            else:
+                add_panel_trace(fig,
+                go.Heatmap(
+                    z=[[x] for x in tmp.values.tolist()],
+                    y=tmp.index.values.tolist(),
+                    colorscale=colorscale,
+                    showscale=False
+                ),indices[icount]
+                )
         fig.layout[indices[icount]['yaxis_name']].update(showticklabels=False,ticks="")
         fig.layout[indices[icount]['xaxis_name']].update(showticklabels=False,ticks="")
         icount+=1
 
     ###HEATMAP
-    fig.append_trace(
-            go.Heatmap(
-                z=pairwise_array.loc[ordered_labels,ordered_labels[::-1]].values.tolist(),
-                y=ordered_labels[::-1],x=ordered_labels,
-                zmin=pairwise_array.min().min(),
-                zmax=pairwise_array.max().max(),
-                showscale=False,
-                colorscale="RdBu"
-            ),indices[icount]['xaxis_num'],indices[icount]['yaxis_num']
-    )
+    order=[positions[x] for x in ordered_labels]
+    if render=='raster':
+        add_raster_panel(fig,pairwise_values,indices[icount],np.nanmin(pairwise_values),np.nanmax(pairwise_values),"RdBu",
+                         raster_pixels,raster_aggregate,order,order[::-1])
+    else:
+        add_panel_trace(fig,
+                go.Heatmap(
+                    z=np.asarray(pairwise_values[np.ix_(order,order[::-1])]).tolist(),
+                    y=ordered_labels[::-1],x=ordered_labels,
+                    zmin=np.nanmin(pairwise_values),
+                    zmax=np.nanmax(pairwise_values),
+                    showscale=False,
+                    colorscale="RdBu"
+                ),indices[icount]
+        )
     fig.layout[indices[icount]['yaxis_name']].update(side='right')
     fig.layout[indices[icount]['xaxis_name']].update(side='bottom',showticklabels=False,ticks="")
     icount+=1
@@ -996,7 +1120,7 @@ def plotPairwise_heatmap(pairwise_array,stats,annotations,annotations_category_c
                     ))
                 ]+[round(annotations_category_colored[xanno]['cmax'],2)]
 
-            fig.append_trace(
+            add_panel_trace(fig,
             go.Scattergl(
                 x=tmp,
                 y=[xanno]*len(tmp),
@@ -1007,7 +1131,7 @@ def plotPairwise_heatmap(pairwise_array,stats,annotations,annotations_category_c
                 text=[tmp[0]]+["" for x in range(0,len(tmp)-3)]+[tmp[-1]],
                 textfont=dict(size=10,color="black"),
                 textposition=['middle left']+['middle left']*18+["middle right"],
-            ),indices[icount]['xaxis_num'],indices[icount]['yaxis_num']
+            ),indices[icount]
             )
             fig['layout'][indices[icount]['yaxis_name']].update(showticklabels=True,showgrid=False,zeroline=False,tickfont=dict(size=10))
             fig['layout'][indices[icount]['xaxis_name']].update(showticklabels=False,
@@ -1020,7 +1144,7 @@ def plotPairwise_heatmap(pairwise_array,stats,annotations,annotations_category_c
                                       ) 
         else:
             tmp=[annotations_category_colored[xanno][x]['num'] for x in list(annotations_category_colored[xanno].keys())[1:]]
-            fig.append_trace(
+            add_panel_trace(fig,
             go.Scattergl(
                 x=tmp,
                 y=[xanno]*len(list(annotations_category_colored[xanno].keys())[1:]),
@@ -1031,17 +1155,17 @@ def plotPairwise_heatmap(pairwise_array,stats,annotations,annotations_category_c
                 mode='markers+text',
                 textposition='middle left',
                 textfont=dict(color='black',size=10)
-            ),indices[icount]['xaxis_num'],indices[icount]['yaxis_num']
+            ),indices[icount]
             )
             fig['layout'][indices[icount]['yaxis_name']].update(showticklabels=True,showgrid=False,zeroline=False,tickfont=dict(size=10))
             fig['layout'][indices[icount]['xaxis_name']].update(showticklabels=False,showgrid=False,zeroline=False,range=[-0.3,1.1])
         icount+=1
 
     ### Set pairwise array max/min and plot legend
-    dist_min=float(pairwise_array.min().min())
-    dist_max=float(pairwise_array.max().max())
+    dist_min=float(np.nanmin(pairwise_values))
+    dist_max=float(np.nanmax(pairwise_values))
 
-    fig.append_trace(
+    add_panel_trace(fig,
         go.Scattergl(
             x=np.arange(dist_min,dist_max,((dist_max-dist_min)/20)),
             text=[int(dist_min)]+["" for x in np.arange(dist_min,dist_max,((dist_max-dist_min)/20))[:-2]]+[round(dist_max,2)],
@@ -1056,7 +1180,7 @@ def plotPairwise_heatmap(pairwise_array,stats,annotations,annotations_category_c
             color="black"
             ),
             showlegend=False,
-        ),indices[icount]['xaxis_num'],indices[icount]['yaxis_num']
+        ),indices[icount]
         )
     fig['layout'][indices[icount]['yaxis_name']].update(showticklabels=True,showgrid=False,zeroline=False,tickfont=dict(size=10))
     fig['layout'][indices[icount]['xaxis_name']].update(showticklabels=False,showgrid=False,zeroline=False,range=[dist_min-2*((dist_max-dist_min)/20),dist_max+((dist_max-dist_min)/20)])
@@ -1071,17 +1195,13 @@ def plotPairwise_heatmap(pairwise_array,stats,annotations,annotations_category_c
     return(fig,pdclust_clusters)
 
 ##################################################################
-def plot_scatter_MDS(pairwise_array,stats,annotation,annotations_category_colored):
+def plot_scatter_embedding(coordinates,labels,stats,annotation,annotations_category_colored,title,axis_titles=("Dimension 1","Dimension 2")):
     """
-    Function for plotting MDS on pairwise distances
-    Example : plot_scatter_MDS(.pool_pairwise_combination()  Output,.pullStatistics() statistics Output,['Methylation',"Example Annotation"],.ready_annotations() output)
+    Function plots cell coordinates (labels x 2) as a scatter coloured by annotation
+    Example : plot_scatter_embedding(.cell_embedding() output['coordinates'],labels,.pullStatistics() statistics Output,'average_meth',.ready_annotations() output,'MDS average_meth')
     Returns scatterplot figure instance with annotations 
     """
-    print("Running : MDS scatter plot")
-    t0 = time.time()
-    embedding = MDS(n_components=2,dissimilarity='precomputed', random_state=1)
-    X_transformed = embedding.fit_transform(pairwise_array)
-    
+    X_transformed=coordinates
     fig = plotly.subplots.make_subplots(rows=1,cols=1)
     if isinstance(stats.loc[:,annotation].values.tolist()[0],float):
         fig.append_trace(go
@@ -1091,7 +1211,7 @@ def plot_scatter_MDS(pairwise_array,stats,annotation,annotations_category_colore
                              marker=dict(
                                  symbol='square',
                                  size=20,
-                                 color=stats.loc[pairwise_array.columns.tolist(),annotation].values.tolist(),
+                                 color=stats.loc[labels,annotation].values.tolist(),
                                  cmin=annotations_category_colored[annotation]['cmin'],
                                  cmax=annotations_category_colored[annotation]['cmax'],
                                  colorscale=annotations_category_colored[annotation]['color'],
@@ -1101,8 +1221,8 @@ def plot_scatter_MDS(pairwise_array,stats,annotation,annotations_category_colore
                              )
                              ,1,1)
     else:
-        for inst in stats.loc[pairwise_array.columns.tolist(),"pdclust_clusters"].unique().tolist():
-            tmp=[i for i,val in enumerate(stats.loc[pairwise_array.columns.tolist(),annotation].values.tolist()) if val==inst]
+        for inst in stats.loc[labels,"pdclust_clusters"].unique().tolist():
+            tmp=[i for i,val in enumerate(stats.loc[labels,annotation].values.tolist()) if val==inst]
             fig.append_trace(go
                              .Scattergl(
                                  x=X_transformed[tmp,0],
@@ -1122,171 +1242,164 @@ def plot_scatter_MDS(pairwise_array,stats,annotation,annotations_category_colore
                                    linecolor='lightgrey',
                                    zerolinecolor='lightgrey',
                                    zeroline=True,
-                                   title="Dimension 1")
+                                   title=axis_titles[0])
     fig['layout']['yaxis1'].update(gridcolor='lightgrey',
                                    linecolor='lightgrey',
                                    zerolinecolor='lightgrey',
                                    zeroline=True,
-                                   title="Dimension 2")
+                                   title=axis_titles[1])
     fig['layout'].update(width=800,
                          height=800,
-                         title='MDS '+annotation,
+                         title=title,
                          paper_bgcolor='rgb(255,255,255)',
                          plot_bgcolor='rgb(255,255,255)'
                         )
+    return(fig)
+###############################################################
+def plot_scatter_MDS(pairwise_array,stats,annotation,annotations_category_colored,method='smacof',landmarks=500,cache_dir=None):
+    """
+    Function for plotting MDS on pairwise distances
+    Example : plot_scatter_MDS(.pool_pairwise_combination()  Output,.pullStatistics() statistics Output,['Methylation',"Example Annotation"],.ready_annotations() output)
+    pairwise_array may be a pivoted DataFrame or a distance matrix dictionary (.open_distance_matrix())
+    method 'smacof', 'classical' or 'landmark' (on landmarks cells) MDS, embeddings are cached (.cell_embedding()), on disk in cache_dir if given
+    Returns scatterplot figure instance with annotations 
+    """
+    print("Running : MDS scatter plot")
+    t0 = time.time()
+    labels,pairwise_values=distance_matrix_values(pairwise_array)
+    X_transformed = cell_embedding(pairwise_values,labels,method,2,cache_dir,landmarks=landmarks)['coordinates']
+    
+    fig=plot_scatter_embedding(X_transformed,labels,stats,annotation,annotations_category_colored,'MDS '+annotation)
     print(time.time()-t0)
     return(fig)
 ###############################################################
-def plot_scatter_pca(pairwise_array,stats,annotation,annotations_category_colored):
+def plot_scatter_pca(pairwise_array,stats,annotation,annotations_category_colored,method='pca',cache_dir=None):
     """
     Function for plotting PCA on pairwise distances
     Example : plot_scatter_pca(.pool_pairwise_combination()  Output,.pullStatistics() statistics Output,['Methylation',"Example Annotation"],.ready_annotations() output)
+    pairwise_array may be a pivoted DataFrame or a distance matrix dictionary (.open_distance_matrix())
+    method 'pca' or 'randomized_pca', embeddings are cached (.cell_embedding()), on disk in cache_dir if given
     Returns scatterplot figure instance with annotations 
     """
     print("Running : PCA scatter plot")
     t0 = time.time()
-    pca = PCA(n_components=2)
-    X_transformed=pca.fit_transform(pairwise_array)
+    labels,pairwise_values=distance_matrix_values(pairwise_array)
+    embedding=cell_embedding(pairwise_values,labels,method,2,cache_dir)
+    X_transformed=embedding['coordinates']
     
-    fig = plotly.subplots.make_subplots(rows=1,cols=1)
-    if isinstance(stats.loc[:,annotation].values.tolist()[0],float):
-        fig.append_trace(go
-                         .Scattergl(
-                             x=X_transformed[:,0],
-                             y=X_transformed[:,1],
-                             marker=dict(
-                                 symbol='square',
-                                 size=20,
-                                 color=stats.loc[pairwise_array.columns.tolist(),annotation].values.tolist(),
-                                 cmin=annotations_category_colored[annotation]['cmin'],
-                                 cmax=annotations_category_colored[annotation]['cmax'],
-                                 colorscale=annotations_category_colored[annotation]['color'],
-                                 colorbar=dict(thickness=20)
-                             ),
-                             mode='markers',
-                             )
-                             ,1,1)
-    else:
-        for inst in stats.loc[pairwise_array.columns.tolist(),"pdclust_clusters"].unique().tolist():
-            tmp=[i for i,val in enumerate(stats.loc[pairwise_array.columns.tolist(),annotation].values.tolist()) if val==inst]
-            fig.append_trace(go
-                             .Scattergl(
-                                 x=X_transformed[tmp,0],
-                                 y=X_transformed[tmp,1],
-                                 name=inst,
-                                 marker=dict(
-                                     symbol='square',
-                                     size=20,
-                                     color=[annotations_category_colored[annotation][inst]['color']]*len(tmp)
-                                     ),
-                                 mode='markers',
-                                 showlegend=True
-                             ),1,1) 
-
-    fig['layout']['xaxis1'].update(gridcolor='lightgrey',
-                                   linecolor='lightgrey',
-                                   zerolinecolor='lightgrey',
-                                   zeroline=True,
-                                   title="PCA1 ("+str(round(pca.explained_variance_ratio_[0],2))+")")
-    fig['layout']['yaxis1'].update(gridcolor='lightgrey',
-                                   linecolor='lightgrey',
-                                   zerolinecolor='lightgrey',
-                                   zeroline=True,
-                                   title="PCA2 ("+str(round(pca.explained_variance_ratio_[0],2))+")")
-    fig['layout'].update(width=800,
-                         height=800,
-                         title='PCA '+annotation,
-                         paper_bgcolor='rgb(255,255,255)',
-                         plot_bgcolor='rgb(255,255,255)',
-                        )        
-        
+    fig=plot_scatter_embedding(X_transformed,labels,stats,annotation,annotations_category_colored,'PCA '+annotation,
+                               ["PCA1 ("+str(round(embedding['explained_variance_ratio'][0],2))+")",
+                                "PCA2 ("+str(round(embedding['explained_variance_ratio'][1],2))+")"])
+    print(time.time()-t0)
+    return(fig)
+###############################################################
+def plot_scatter_graph(graph,stats,annotation,annotations_category_colored,method='tsne',cache_dir=None):
+    """
+    Function for plotting a 2D layout of cells from a nearest neighbour graph, for cohorts too large for N x N matrices
+    Example : plot_scatter_graph(.pool_pairwise_knn() output,.pullStatistics() statistics Output,'average_meth',.ready_annotations() output)
+    method 'tsne' or 'force', embeddings are cached (.graph_embedding()), on disk in cache_dir if given
+    Returns scatterplot figure instance with annotations 
+    """
+    print("Running : Graph scatter plot")
+    t0 = time.time()
+    embedding=graph_embedding(graph,method,cache_dir=cache_dir)
+    fig=plot_scatter_embedding(embedding['coordinates'],embedding['labels'],stats,annotation,annotations_category_colored,
+                               method+' '+annotation)
     print(time.time()-t0)
     return(fig)
+###############################################################
+def plot_scatter_methylation_pca(matrix,stats,annotation,annotations_category_colored,chr_list=None,min_cells=2):
+    """
+    Function for plotting PCA of the cell x CpG (.load_cpg_matrix()) or cell x region (.window_methylation_features()) methylation
+    No pairwise distances are needed, loadings of each component are returned (.methylation_pca())
+    Example : plot_scatter_methylation_pca(.window_methylation_features() output,.pullStatistics() statistics Output,'average_meth',.ready_annotations() output)
+    Returns scatterplot figure instance with annotations and loadings Dataframe
+    """
+    print("Running : Methylation PCA scatter plot")
+    t0 = time.time()
+    embedding=methylation_pca(matrix,2,chr_list,min_cells)
+    fig=plot_scatter_embedding(embedding['coordinates'],embedding['labels'],stats,annotation,annotations_category_colored,'PCA '+annotation,
+                               ["PCA1 ("+str(round(embedding['explained_variance_ratio'][0],2))+")",
+                                "PCA2 ("+str(round(embedding['explained_variance_ratio'][1],2))+")"])
+    print(time.time()-t0)
+    return(fig,embedding['loadings'])
 #################################################################################################
-def merge_cpgs(cpgs,core_count=4):
+def merge_cpgs(cpgs,core_count=4,chr_list=None,reference_cpgs=None,smoother='bsseq'):
     """
     Wrapper merging CpG libraries into a smoothed library via Bsseq
     Requires Nested array of consisting of 1xN number of Groups, each group consisting of unique index, and Number of cores
+    Group methylated/total read counts are summed per CpG on chr_list (default chr1-22, X, Y) in one streaming pass (.group_cpg_counts()),
+    straight into groups x CpGs arrays over reference_cpgs (/ref/<ref>.CG.bed.gz, written by .checkReferenceFiles()) if given
+    smoother 'bsseq' hands the counts to Bsseq BSmooth, 'python' smooths per group and chromosome in a process pool
+    (.smooth_group_counts()). The python smoother is not BSmooth-equivalent : it follows BSmooth's clusters and NA rule
+    but fits by its own Newton iterations, and no stored BSmooth output has validated it yet (.check_smoothing_fixture())
     Example: merge_cpg([[A1,A2,A3],[B1,B2,B3],[C1,C2,C3]],4)
     Returns normalized CpG methylation dataframe
     """
     print("Running : Merging CpGs")
     t0 = time.time()
-    bsseq = importr('bsseq')
-    
-    cpg_tracker=pd.DataFrame()
-    cpg_dataframes=[]
-
-    ###Name Groups
-    for group in range(0,len(cpgs)):
-        for sample in cpgs[group]:
-            cpg_tracker.loc[sample.split("/")[-1].split(".")[0],"file"]=sample
-            cpg_tracker.loc[sample.split("/")[-1].split(".")[0],"group"]=chr(group+65)
+    if chr_list is None:
+        chr_list=["chr"+str(x) for x in range(1,23)]+["chrX","chrY"]
 
-    ###Read in CpGs per group member
-    for sample_name,file in zip(cpg_tracker.index.values.tolist(),cpg_tracker['file'].values.tolist()):
-        cpg_dataframes.append(
-            pd.read_csv(file,
-                        names=['chr','start','end','meth_cov','unmeth_cov','cov','meth_frac'],
-                        usecols=['chr','start','cov','meth_frac'],
-                        compression='gzip',
-                        sep='\t'
-                       ).set_index(['chr','start']).rename(columns={"cov":sample_name+"_cov","meth_frac":sample_name+"_meth"})
-        )
-
-    ###Combine CpGs into single Dataframe
-    merged_cpgs=reduce(lambda  left,right: pd.merge(left,right,left_index=True, right_index=True,how='outer'),cpg_dataframes)
-    merged_cpgs.replace(np.NaN,0,inplace=True)
-    del(cpg_dataframes)
+    ###Sum counts per group
+    cpg_index=None if reference_cpgs is None else load_reference_cpgs(reference_cpgs,chr_list)
+    counts=group_cpg_counts(cpgs,chr_list,core_count,cpg_index)
+    if smoother=='python':
+        smooth_python_df=smooth_group_counts(counts,chr_list,1000,70,core_count)
+        print(time.time()-t0)
+        return(smooth_python_df)
+    bsseq = importr('bsseq')
+    covered=np.flatnonzero(counts['coverage'].sum(axis=0)>0)
 
-    ###Convert each aspect of Python Dataframe into R data.table
+    ###Convert each aspect of Python arrays into R data.table
     ro.r.assign(
         "meth",
         ro.conversion.py2rpy(
-            merged_cpgs.loc[:,[x+"_meth" for x in cpg_tracker.index.values.tolist()]].reset_index(drop=True)
+            pd.DataFrame(counts['methylated'][:,covered].T,columns=counts['groups'])
         )
     )
     ro.r.assign(
         "cov",
-        ro.conversion.py2rpy(merged_cpgs.loc[:,[x+"_cov" for x in cpg_tracker.index.values.tolist()]].reset_index(drop=True)
+        ro.conversion.py2rpy(pd.DataFrame(counts['coverage'][:,covered].T,columns=counts['groups'])
                             )
     )
     ro.r.assign(
-        "loc",ro.conversion.py2rpy(merged_cpgs.reset_index().loc[:,["chr","start"]]
+        "loc",ro.conversion.py2rpy(pd.DataFrame({'chr':np.asarray(chr_list,dtype=object)[counts['cpg_index'][covered]>>32],
+                                                 'start':counts['cpg_index'][covered]&0xFFFFFFFF})
                                   )
     )
     ro.r.assign(
         "names_list",
-        ro.StrVector(cpg_tracker.index.values.tolist())
-    )
-    ro.r.assign(
-        "group_list",
-        ro.StrVector(cpg_tracker['group'].values.tolist())
+        ro.StrVector(counts['groups'])
     )
-    
-    ###Covert R data.table into BSseq object
-    ro.r('bsseq_obj<-BSseq(M = as.matrix(meth), Cov = as.matrix(cov), chr = loc$chr, pos = loc$start, sampleNames =names_list)')
+    del counts
+
+    ###Covert R data.table into BSseq object, already collapsed by group
+    ro.r('combined<-BSseq(M = as.matrix(meth), Cov = as.matrix(cov), chr = loc$chr, pos = loc$start, sampleNames =names_list)')
     ###Remove intermidates
     ro.r('rm(meth)')
     ro.r('rm(cov)')
     ro.r('rm(loc)')
-    ###Collapse BSseq based on groups
-    ro.r('combined<-collapseBSseq(bsseq_obj,group=group_list)')
-    ro.r('rm(bsseq_obj)')
     ###Run smoothing function 
     ###Becareful with thread allocation. python is extremely odd in this scenario where the same variables/memory usage is applied per thread
     ro.r('smoothed_bsseq<-BSmooth(combined, h = 1000, verbose=TRUE, BPPARAM = MulticoreParam(workers = '+str(core_count)+'))')
     ro.r('rm(combined)')
 
-    ###Convert BSseq into Python DataFrame
+    ###Convert BSseq into Python DataFrame, each matrix converted once as a NumPy array
+    t1 = time.time()
+    with localconverter(ro.default_converter+numpy2ri.converter):
+        chromosomes=np.asarray(ro.r('as.character(seqnames(granges(smoothed_bsseq)))'))
+        starts=np.asarray(ro.r('as.numeric(start(granges(smoothed_bsseq)))'))
+        meth=np.asarray(ro.r('as.matrix(getMeth(smoothed_bsseq))'))
+        cov=np.asarray(ro.r('as.matrix(getCoverage(smoothed_bsseq))'))
     smooth_python_df=pd.DataFrame()
-
-    
-    smooth_python_df['chr']=[x for x in  ro.r('as.character(seqnames(granges(smoothed_bsseq)))')]
-    smooth_python_df['start']=[x for x in  ro.r('as.numeric(start(granges(smoothed_bsseq)))')]
-    for group,num in zip(cpg_tracker['group'].unique().tolist(),range(0,len(cpg_tracker['group'].unique().tolist()))):
-            smooth_python_df['meth_'+group]=[round(x[num],2) for x in ro.r('getMeth(smoothed_bsseq)')]
-            smooth_python_df['cov_'+group]=[round(x[num],2) for x in ro.r('getCoverage(smoothed_bsseq)')]
+    smooth_python_df['chr']=chromosomes
+    smooth_python_df['start']=starts
+    for num,group in enumerate([chr(x+65) for x in range(0,len(cpgs))]):
+            smooth_python_df['meth_'+group]=np.round(meth[:,num],2)
+            smooth_python_df['cov_'+group]=np.round(cov[:,num],2)
+    del meth,cov
+    print("Converted smoothed Bsseq in "+str(time.time()-t1))
     
     ro.r('rm(smoothed_bsseq)')
     print(time.time()-t0)
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+import os
+import io
+import multiprocessing as mp
+import time
+import pickle
+import json
+import numpy as np
+import pandas as pd
+import plotly
+import plotly.graph_objs as go
+try:
+    from PIL import Image
+except ImportError:
+    ### without Pillow reports are written as html
+    Image = None
+
+
+############################################################
+###Figures are saved as <path>.json (figure with large arrays replaced by references) and <path>.npz (the arrays)
+def split_arrays(value,arrays,min_size=64):
+    """
+    Function replaces numeric or string arrays of at least min_size values in a figure dictionary by {'__array__':key},
+    moving them into arrays
+    Returns figure dictionary without large arrays
+    """
+    if isinstance(value,dict):
+        return({key:split_arrays(x,arrays,min_size) for key,x in value.items()})
+    if isinstance(value,(list,tuple,np.ndarray)):
+        try:
+            array=np.asarray(value)
+        except ValueError:
+            array=np.asarray(value,dtype=object) if isinstance(value,np.ndarray) else None
+        if array is not None and array.size>=min_size and array.dtype.kind in 'biufU' and \
+            (array.dtype.kind!='U' or all(isinstance(x,str) for x in np.asarray(value,dtype=object).flat)):
+            key='a'+str(len(arrays))
+            arrays[key]=array
+            return({'__array__':key})
+        return([split_arrays(x,arrays,min_size) for x in (value.tolist() if isinstance(value,np.ndarray) else value)])
+    return(value)
+
+def merge_arrays(value,arrays):
+    """
+    Function restores the arrays referenced by .split_arrays()
+    """
+    if isinstance(value,dict):
+        if list(value.keys())==['__array__']:
+            return(arrays[value['__array__']])
+        return({key:merge_arrays(x,arrays) for key,x in value.items()})
+    if isinstance(value,list):
+        return([merge_arrays(x,arrays) for x in value])
+    return(value)
+
+def save_figure(fig,path):
+    """
+    Function saves a figure as path.json (layout and small values) and path.npz (binary arrays, e.g. heatmap matrices)
+    Unlike pickles the files are independent of the plotly version and much smaller for large heatmaps
+    Example : save_figure(methylation_figure,'/outdirectory/results/figA')
+    """
+    arrays={}
+    spec=split_arrays(fig.to_dict(),arrays)
+    with open(path+".json","w") as spec_file:
+        json.dump(spec,spec_file,cls=plotly.utils.PlotlyJSONEncoder)
+    np.savez(path+".npz",**arrays)
+
+def load_figure(path):
+    """
+    Function loads a figure saved by .save_figure(), path with or without .json
+    Arrays are read from the .npz sidecar only when referenced
+    Example : load_figure('/outdirectory/results/figA.json')
+    Returns figure instance
+    """
+    path=path[:-len(".json")] if path.endswith(".json") else path
+    spec=json.load(open(path+".json"))
+    with np.load(path+".npz",allow_pickle=False) as arrays:
+        return(go.Figure(merge_arrays(spec,arrays)))
+
+###Figures are written by a pool of renderer processes, started on the first submitted figure
+def figure_queue(core_count=4):
+    """
+    Function creates a figure rendering queue for .submit_figure()
+    No renderer is started until the first figure is submitted
+    Example : figure_queue(4)
+    Returns queue dictionary
+    """
+    return({'core_count':core_count,'pool':None,'jobs':[]})
+
+def render_figure(figure_json,path,formats,width,height,scale):
+    """
+    Renderer process task writing one figure to path.<format> for each of formats ('png','svg','pdf','html','spec','pkl')
+    'spec' saves path.json and path.npz (.save_figure())
+    Each renderer keeps its own image export server between figures
+    Returns list of (path, format, seconds)
+    """
+    fig=plotly.io.from_json(figure_json)
+    times=[]
+    for file_format in formats:
+        t0 = time.time()
+        if file_format=='html':
+            fig.write_html(path+".html",include_plotlyjs='cdn')
+        elif file_format=='spec':
+            save_figure(fig,path)
+        elif file_format=='pkl':
+            pickle.dump(fig, open(path+".pkl", "wb" ) )
+        else:
+            fig.write_image(path+"."+file_format,format=file_format,width=width,height=height,scale=scale)
+        times.append((path,file_format,time.time()-t0))
+    return(times)
+
+def submit_figure(queue,fig,out_dir,file_name,formats=('png','spec'),width=800,height=800,scale=10):
+    """
+    Function queues a figure for rendering to out_dir/results/file_name.<format>, starting the renderers if needed
+    width, height and scale apply to image formats, so large raster figures can be written at lower scale
+    Example : submit_figure(queue,methylation_figure,'/outdirectory/','methylation_boxplot',['png','html'])
+    """
+    if queue['pool'] is None:
+        os.environ['TMPDIR']="/out_dir/tmp"
+        queue['pool']=mp.Pool(queue['core_count'])
+    queue['jobs'].append(queue['pool'].apply_async(render_figure,
+        (fig.to_json(),out_dir+"/results/"+file_name,list(formats),width,height,scale)))
+
+def finish_figures(queue):
+    """
+    Function waits for all queued figures and stops the renderers
+    Example : finish_figures(queue)
+    Returns Dataframe of render time per figure and format
+    """
+    print("Running : Rendering "+str(len(queue['jobs']))+" figures")
+    t0 = time.time()
+    times=[]
+    for job in queue['jobs']:
+        times+=job.get()
+    if queue['pool'] is not None:
+        queue['pool'].close()
+        queue['pool'].join()
+    queue['pool']=None
+    queue['jobs']=[]
+    print(time.time()-t0)
+    return(pd.DataFrame(times,columns=['file','format','seconds']))
+
+def write_report(figure_files,report_path,report_format='pdf',width=800,height=800,scale=2):
+    """
+    Function assembles figures (.json specs of .plot_figure(), or older .pkl) into one report, loading and writing one figure at a time
+    report_format 'pdf' appends each figure as a page rendered at width x height x scale pixels,
+    'html' writes a single self-contained page embedding plotly.js once
+    Example : write_report(sorted(glob.glob('/outdirectory/results/fig*.json')),'/outdirectory/results/out.pdf')
+    Returns path of the report
+    """
+    print("Running : Writing report of "+str(len(figure_files))+" figures")
+    t0 = time.time()
+    if report_format=='pdf' and Image is None:
+        print("Pillow not available, writing html report")
+        report_format='html'
+        report_path=os.path.splitext(report_path)[0]+".html"
+    if report_format=='html':
+        with open(report_path,"w") as report:
+            report.write('<html><head><meta charset="utf-8"/></head><body>\n')
+            for num,figure_file in enumerate(figure_files):
+                fig=pickle.load(open(figure_file,"rb")) if figure_file.endswith(".pkl") else load_figure(figure_file)
+                report.write(plotly.io.to_html(fig,full_html=False,include_plotlyjs=(num==0),
+                                               default_width=width,default_height=height)+"\n")
+                del fig
+            report.write('</body></html>\n')
+    else:
+        for num,figure_file in enumerate(figure_files):
+            fig=pickle.load(open(figure_file,"rb")) if figure_file.endswith(".pkl") else load_figure(figure_file)
+            page=Image.open(io.BytesIO(fig.to_image(format='png',width=width,height=height,scale=scale))).convert("RGB")
+            page.save(report_path,"PDF",resolution=72.0*scale,append=(num>0))
+            del fig,page
+    print(time.time()-t0)
+    return(report_path)
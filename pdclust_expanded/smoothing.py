@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+
+import os
+import multiprocessing as mp
+import time
+import numpy as np
+import pandas as pd
+
+
+############################################################
+###Local likelihood smoothing after bsseq::BSmooth : binomial local quadratic fit of the logit methylation,
+###tricube kernel over the larger of h bp and the ns nearest covered CpGs, weighted by coverage,
+###within clusters of CpGs split at gaps above max_gap. Not BSmooth-equivalent (Newton fit instead of locfit) until
+###checked against stored BSmooth output with .check_smoothing_fixture()
+def smoothing_bandwidths(covered_positions,positions,h=1000,ns=70):
+    """
+    Function returns per position the larger of h and the distance to the ns-th nearest covered CpG
+    Requires more than ns covered CpGs, as guaranteed by .smooth_positions()
+    """
+    nearest=np.searchsorted(covered_positions,positions)
+    candidates=np.clip(nearest[:,None]+np.arange(-ns,ns)[None,:],0,len(covered_positions)-1)
+    distances=np.abs(covered_positions[candidates]-positions[:,None]).astype(np.float64)
+    ###Clipped candidates repeat the end CpGs, count each once
+    distances[np.diff(candidates,axis=1,prepend=-1)==0]=np.inf
+    return(np.maximum(h,np.partition(distances,ns-1,axis=1)[:,ns-1]))
+
+def smooth_positions(positions,methylated,coverage,h=1000,ns=70,max_gap=10**8,chunk_size=2048,iterations=25):
+    """
+    Function smooths the methylation of one sample along one chromosome (sorted positions, counts per CpG)
+    As BSmooth, positions are split into clusters at gaps above max_gap and clusters with ns or fewer covered CpGs
+    are left unsmoothed (NaN); each remaining cluster is fitted on its own CpGs (.smooth_cluster())
+    Returns smoothed methylation per position
+    """
+    smoothed=np.full(len(positions),np.nan)
+    bounds=np.concatenate([[0],np.flatnonzero(np.diff(positions)>max_gap)+1,[len(positions)]])
+    for a,b in zip(bounds[:-1],bounds[1:]):
+        if (coverage[a:b]>0).sum()>ns:
+            smoothed[a:b]=smooth_cluster(positions[a:b],methylated[a:b],coverage[a:b],h,ns,chunk_size,iterations)
+    return(smoothed)
+
+def smooth_cluster(positions,methylated,coverage,h=1000,ns=70,chunk_size=2048,iterations=25):
+    """
+    Function smooths one cluster of more than ns covered CpGs
+    Each position gets a local quadratic logistic regression of the covered CpGs, fitted by Newton iterations
+    vectorised over chunk_size positions. As BSmooth, calls are bounded to [0.01,Cov-0.01]/Cov
+    Returns smoothed methylation per position (NaN where no covered CpG has kernel weight)
+    """
+    covered=coverage>0
+    smoothed=np.full(len(positions),np.nan)
+    covered_positions=positions[covered].astype(np.float64)
+    weights_cov=coverage[covered].astype(np.float64)
+    calls=np.clip(methylated[covered],0.01,weights_cov-0.01)/weights_cov
+    for start in range(0,len(positions),chunk_size):
+        centres=positions[start:start+chunk_size].astype(np.float64)
+        bandwidths=smoothing_bandwidths(covered_positions,centres,h,ns)
+        lo=np.searchsorted(covered_positions,centres-bandwidths,'left')
+        hi=np.searchsorted(covered_positions,centres+bandwidths,'right')
+        window=np.arange(0,max((hi-lo).max(),1))
+        idx=lo[:,None]+window[None,:]
+        inside=idx<hi[:,None]
+        idx=np.minimum(idx,len(covered_positions)-1)
+        offsets=(covered_positions[idx]-centres[:,None])/bandwidths[:,None]
+        kernel=np.where(inside,np.clip(1-np.abs(offsets)**3,0,None)**3,0)
+        weights=kernel*weights_cov[idx]
+        y=calls[idx]
+        design=np.stack([np.ones(offsets.shape),offsets,offsets**2],axis=2)
+        ###Without weighted CpGs (e.g. the only covered CpG on the bandwidth edge) there is no estimate
+        fitted=weights.sum(axis=1)>0
+        mean=np.where(fitted,(weights*y).sum(axis=1)/np.where(fitted,weights.sum(axis=1),1),0.5)
+        beta=np.zeros((len(centres),3))
+        beta[:,0]=np.log(mean/(1-mean))
+        for x in range(0,iterations):
+            p=1/(1+np.exp(-np.einsum('cwk,ck->cw',design,beta)))
+            gradient=np.einsum('cwk,cw->ck',design,weights*(y-p))
+            hessian=np.einsum('cwk,cwl,cw->ckl',design,design,weights*p*(1-p))+1e-8*np.identity(3)
+            step=np.linalg.solve(hessian,gradient[:,:,None])[:,:,0]
+            beta+=step
+            if np.abs(step).max()<1e-6:
+                break
+        smoothed[start:start+chunk_size]=np.where(fitted,1/(1+np.exp(-beta[:,0])),np.nan)
+    return(smoothed)
+
+def smooth_task(task):
+    """
+    Pool task smoothing one (group, chromosome)
+    """
+    positions,methylated,coverage,h,ns,max_gap=task
+    return(smooth_positions(positions,methylated,coverage,h,ns,max_gap))
+
+def smooth_group_counts(counts,chr_list,h=1000,ns=70,core_count=4,max_gap=10**8):
+    """
+    Function smooths group pseudo-bulk counts (.group_cpg_counts()) per group and chromosome across core_count processes
+    NumPy approximation of BSmooth(h=1000) on the collapsed BSseq object : clusters follow the CpGs covered in any group,
+    as the BSseq loci. Not BSmooth-equivalent until validated with .check_smoothing_fixture()
+    Example : smooth_group_counts(.group_cpg_counts() output,chr_list,1000,70,4)
+    Returns Dataframe of chr, start, meth_<group> (smoothed) and cov_<group> (raw) as .merge_cpgs()
+    """
+    print("Running : Smoothing CpGs")
+    t0 = time.time()
+    covered=np.flatnonzero(counts['coverage'].sum(axis=0)>0)
+    keys=counts['cpg_index'][covered]
+    chromosomes=keys>>32
+    positions=keys&0xFFFFFFFF
+    bounds=np.searchsorted(chromosomes,np.unique(chromosomes))
+    bounds=np.append(bounds,len(keys))
+    tasks=[(positions[a:b],counts['methylated'][num,covered[a:b]],counts['coverage'][num,covered[a:b]],h,ns,max_gap)
+           for num in range(0,len(counts['groups'])) for a,b in zip(bounds[:-1],bounds[1:])]
+    pool = mp.Pool(core_count)
+    smoothed=pool.map(smooth_task,tasks)
+    pool.close()
+    del pool
+    smooth_python_df=pd.DataFrame()
+    smooth_python_df['chr']=np.asarray(chr_list,dtype=object)[chromosomes]
+    smooth_python_df['start']=positions
+    chromosome_count=len(bounds)-1
+    for num,group in enumerate(counts['groups']):
+        smooth_python_df['meth_'+group]=np.round(np.concatenate(smoothed[num*chromosome_count:(num+1)*chromosome_count]),2)
+        smooth_python_df['cov_'+group]=np.round(counts['coverage'][num,covered],2)
+    print(time.time()-t0)
+    return(smooth_python_df)
+
+def compare_smoothing(smooth_python_df,reference_df):
+    """
+    Function compares two .merge_cpgs() outputs (e.g. smoother='python' against smoother='bsseq') on their shared CpGs
+    Example : compare_smoothing(merge_cpgs(groups,4,smoother='python'),merge_cpgs(groups,4))
+    Returns Dataframe per group of shared CpGs, CpGs smoothed by only one of both (NaN in the other),
+    pearson correlation, mean and max absolute difference of meth
+    """
+    shared=smooth_python_df.merge(reference_df,on=['chr','start'],suffixes=('_python','_reference'))
+    comparison=pd.DataFrame()
+    for group in [x[len('meth_'):] for x in smooth_python_df.columns if x.startswith('meth_')]:
+        difference=(shared['meth_'+group+'_python']-shared['meth_'+group+'_reference']).abs()
+        comparison.loc[group,'cpgs']=len(shared)
+        comparison.loc[group,'na_mismatch']=(shared['meth_'+group+'_python'].isna()!=shared['meth_'+group+'_reference'].isna()).sum()
+        comparison.loc[group,'pearson']=shared['meth_'+group+'_python'].corr(shared['meth_'+group+'_reference'])
+        comparison.loc[group,'mean_abs_diff']=difference.mean()
+        comparison.loc[group,'max_abs_diff']=difference.max()
+    return(comparison)
+
+def save_smoothing_fixture(counts,reference_df,chr_list,fixture_dir):
+    """
+    Function stores group counts (.group_cpg_counts()) with their BSmooth result (.merge_cpgs(smoother='bsseq')) as a fixture
+    for .check_smoothing_fixture(), written once on a machine with R/bsseq, e.g. for one chromosome of a real run
+    Example : save_smoothing_fixture(group_cpg_counts(groups,["chr21"],4),merge_cpgs(groups,4,["chr21"]),["chr21"],'/outdirectory/smoothing_fixture')
+    """
+    os.makedirs(fixture_dir,exist_ok=True)
+    np.savez(fixture_dir+"/counts.npz",
+             groups=np.asarray(counts['groups'],dtype=str),
+             chr_list=np.asarray(chr_list,dtype=str),
+             cpg_index=counts['cpg_index'],
+             methylated=counts['methylated'],
+             coverage=counts['coverage'])
+    reference_df.to_csv(fixture_dir+"/bsseq.tsv.gz",sep='\t',index=False)
+
+def check_smoothing_fixture(fixture_dir,core_count=4,h=1000,ns=70,max_gap=10**8):
+    """
+    Function smooths the counts of a .save_smoothing_fixture() fixture in python and compares them with its stored BSmooth output
+    Example : check_smoothing_fixture('/outdirectory/smoothing_fixture',4)
+    Returns .compare_smoothing() Dataframe
+    """
+    with np.load(fixture_dir+"/counts.npz",allow_pickle=False) as fixture:
+        counts={'groups':fixture['groups'].tolist(),
+                'cpg_index':fixture['cpg_index'],
+                'methylated':fixture['methylated'],
+                'coverage':fixture['coverage']}
+        chr_list=fixture['chr_list'].tolist()
+    reference_df=pd.read_csv(fixture_dir+"/bsseq.tsv.gz",sep='\t')
+    return(compare_smoothing(smooth_group_counts(counts,chr_list,h,ns,core_count,max_gap),reference_df))
@@ -32,7 +32,8 @@ stats=stats.merge(annotation.loc[:,['delta_ct','annotation']],left_index=True,ri
 .replace("negative","neg")\
 .replace("positive","pos")
 
-###Initialize figure counts
+###Initialize figure counts and background renderers
+render_queue=figure_queue(core_count)
 figure_count=65
 
 ### Items of interest
@@ -63,7 +64,7 @@ True
 ### Plot Items of interest
 for x,shared_axes in zip(stuff_to_plot,list_shared_axes):
         fig=plotBoxplot(x,stats,['annotation'],project_name,shared_axes)
-        plot_figure(fig,out_dir,"fig"+chr(figure_count))
+        plot_figure(fig,out_dir,"fig"+chr(figure_count),queue=render_queue)
         figure_count+=1
 
 ### Ready annotation for downstream plotting in heatmaps
@@ -73,13 +74,13 @@ qc_annotations_category_colored=ready_annotations(stats.loc[QC_samples,:],['anno
 
 ### Cluster by All CNV and plot
 fig,cnv_clusters=plot_dendrogram_CNV(CNV_array,stats,['annotation','average_meth'],all_annotations_category_colored,3)
-plot_figure(fig,out_dir,"fig"+chr(figure_count));figure_count+=1
+plot_figure(fig,out_dir,"fig"+chr(figure_count),queue=render_queue);figure_count+=1
 ### Cluster by SC CNV only
 fig,cnv_clusters=plot_dendrogram_CNV(CNV_array.loc[:,["Chromosome","Start"]+QC_samples],
                                      stats,
                                      ['annotation','average_meth'],
                                      qc_annotations_category_colored,3)
-plot_figure(fig,out_dir,"fig"+chr(figure_count));figure_count+=1
+plot_figure(fig,out_dir,"fig"+chr(figure_count),queue=render_queue);figure_count+=1
 stats['cnv_clusters']=cnv_clusters
 
 ### Cluster by pdclust and plot
@@ -98,38 +99,40 @@ fig,pdclust_clusters=plotPairwise_heatmap(pairwise_array,stats,
                                           ['annotation','average_meth',"cnv_clusters"],
                                           qc_annotations_category_colored,3,difference_type)
 
-plot_figure(fig,out_dir,"fig"+chr(figure_count));figure_count+=1
+plot_figure(fig,out_dir,"fig"+chr(figure_count),queue=render_queue);figure_count+=1
 stats['pdclust_clusters']=pdclust_clusters
 
 
 ### Plot CpG pairwise via MDS/PCA with annotations
 fig=plot_scatter_MDS(pairwise_array,stats,'pdclust_clusters',qc_annotations_category_colored)
-plot_figure(fig,out_dir,"fig"+chr(figure_count));figure_count+=1
+plot_figure(fig,out_dir,"fig"+chr(figure_count),queue=render_queue);figure_count+=1
 
 fig=plot_scatter_MDS(pairwise_array,stats,'average_meth',qc_annotations_category_colored)
-plot_figure(fig,out_dir,"fig"+chr(figure_count));figure_count+=1
+plot_figure(fig,out_dir,"fig"+chr(figure_count),queue=render_queue);figure_count+=1
 
 fig=plot_scatter_pca(pairwise_array,stats,'pdclust_clusters',qc_annotations_category_colored)
-plot_figure(fig,out_dir,"fig"+chr(figure_count));figure_count+=1
+plot_figure(fig,out_dir,"fig"+chr(figure_count),queue=render_queue);figure_count+=1
 
 fig=plot_scatter_pca(pairwise_array,stats,'average_meth',qc_annotations_category_colored)
-plot_figure(fig,out_dir,"fig"+chr(figure_count));figure_count+=1
+plot_figure(fig,out_dir,"fig"+chr(figure_count),queue=render_queue);figure_count+=1
 ## Merge and find DMRs by specifying groups
 
 CpGa=target_df.loc[stats.query("pdclust_clusters=='A'").index.values.tolist(),'cpg'].values.tolist()
 CpGb=target_df.loc[stats.query("pdclust_clusters=='B'").index.values.tolist(),'cpg'].values.tolist()
 
-smoothed_python_df=merge_cpgs([CpGa,CpGb],core_count)
+smoothed_python_df=merge_cpgs([CpGa,CpGb],core_count,reference_cpgs=ref_dir+"/"+ref+".CG.bed.gz")
 
 min_cpg_cov=3
 min_cpg_in_window=3
 fdr_cutoff=0.01
 cpg_window=200
 dm_CpGs,filtered_dmrs,fig_diff,fig_dist,fig_dmr=find_DMRs(smoothed_python_df,min_cpg_cov,min_cpg_in_window,fdr_cutoff,cpg_window)
-plot_figure(fig_diff,out_dir,"fig"+chr(figure_count));figure_count+=1
-plot_figure(fig_dist,out_dir,"fig"+chr(figure_count));figure_count+=1
-plot_figure(fig_dmr,out_dir,"fig"+chr(figure_count));figure_count+=1
+plot_figure(fig_diff,out_dir,"fig"+chr(figure_count),queue=render_queue);figure_count+=1
+plot_figure(fig_dist,out_dir,"fig"+chr(figure_count),queue=render_queue);figure_count+=1
+plot_figure(fig_dmr,out_dir,"fig"+chr(figure_count),queue=render_queue);figure_count+=1
 
-subprocess.run(["magick",out_dir+"/results/"+"*.png",out_dir+"/results/"+"out.pdf"])
+render_times=finish_figures(render_queue)
+render_times.to_csv(out_dir+"/results/render_times.csv")
+write_report(sorted(glob.glob(out_dir+"/results/fig*.json")),out_dir+"/results/out.pdf")
 stats.to_csv(out_dir+"/results/stats.csv")
 